@@ -0,0 +1,158 @@
+"""
+Benchmark of whole component runs against the stand-in QuickBooks API
+
+Runs Component.run in a temporary data folder for every scenario:
+    entities - entity endpoints of the configuration, their records have nested lines
+    reports  - input table with GeneralLedger, TransactionList, ProfitAndLoss, BalanceSheet
+               and ProfitAndLossQuery summarized by Class
+and prints run time, rows written per second, requests sent (with throttled ones) and peak RSS of the run.
+Every run is made in a forked process, the stand-in server runs in the main process.
+
+Usage: python benchmarks/component_benchmark.py [--scenario entities] [--records 10000] [--latency 0.05]
+       [--rate-429 0.01] [--workers 4] [--pagination keyset] [--output-format csv_gzip] [--batch-requests]
+"""
+import argparse
+import csv
+import datetime
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARKS_PATH)
+sys.path.insert(0, os.path.join(BENCHMARKS_PATH, "..", "src"))
+
+from harness import print_results, run_isolated  # noqa: E402
+from mock_server import MockQuickBooks, redirect  # noqa: E402
+
+COMPANY_ID = "1234567890"
+ENTITY_ENDPOINTS = ["Account", "Class", "Customer", "Invoice", "Item", "Payment", "Term", "TaxCode", "Vendor"]
+REPORT_ROWS = [
+    ("GeneralLedger**", ""),
+    ("TransactionList**", ""),
+    ("ProfitAndLoss**", ""),
+    ("BalanceSheet**", ""),
+    ("ProfitAndLossQuery", "Class")
+]
+# Branch and project the component is allowed to run in
+ENVIRONMENT = {"KBC_BRANCHID": "683762", "KBC_PROJECTID": "9525", "KBC_COMPONENTID": "benchmark",
+               "KBC_CONFIGID": "benchmark", "KBC_STACKID": "connection.keboola.com"}
+
+
+def prepare_data_folder(data_dir, scenario, args):
+    """
+    Configuration, state with valid tokens, so they are not refreshed, and the input table of the scenario
+    """
+    for folder in ("in/tables", "in/files", "out/tables", "out/files"):
+        os.makedirs(os.path.join(data_dir, folder))
+
+    parameters = {
+        "companyid": COMPANY_ID,
+        "endpoints": ENTITY_ENDPOINTS if scenario == "entities" else [],
+        "destination": {"load_type": "full_load", "output_format": args.output_format},
+        "performance": {"max_workers": args.workers, "pagination": args.pagination,
+                        "batch_requests": args.batch_requests}
+    }
+    credentials = {
+        "id": "benchmark",
+        "authorizedFor": "benchmark",
+        "creator": {"id": "1", "description": "benchmark"},
+        "created": "2024-01-01T00:00:00.000000Z",
+        "#data": json.dumps({"access_token": "access", "refresh_token": "refresh"}),
+        "oauthVersion": "2.0",
+        "appKey": "key",
+        "#appSecret": "secret"
+    }
+    config = {"parameters": parameters, "authorization": {"oauth_api": {"credentials": credentials}},
+              "storage": {"input": {"tables": []}}}
+
+    if scenario == "reports":
+        config["storage"]["input"]["tables"].append({"source": "in.c-benchmark.reports", "destination": "reports.csv"})
+        path = os.path.join(data_dir, "in", "tables", "reports.csv")
+        with open(path, 'w', newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["PK", "report", "start_date", "end_date", "segment_data_by"])
+            for report, segment_data_by in REPORT_ROWS:
+                writer.writerow([COMPANY_ID, report, "2024-01-01", "2024-12-31", segment_data_by])
+        with open(path + ".manifest", 'w') as f:
+            json.dump({"columns": ["PK", "report", "start_date", "end_date", "segment_data_by"]}, f)
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    state = {"tokens": {"ts": now.strftime('%Y-%m-%dT%H:%M:%S.%fZ'), "#refresh_token": "refresh",
+                        "#access_token": "access", "expires_at": (now + datetime.timedelta(hours=1)).isoformat()}}
+
+    with open(os.path.join(data_dir, "config.json"), 'w') as f:
+        json.dump(config, f)
+    with open(os.path.join(data_dir, "in", "state.json"), 'w') as f:
+        json.dump(state, f)
+
+
+def run_component(scenario, url, args):
+    data_dir = tempfile.mkdtemp(prefix="quickbooks-benchmark-")
+    try:
+        prepare_data_folder(data_dir, scenario, args)
+        os.environ.update(ENVIRONMENT, KBC_DATADIR=data_dir)
+
+        import client
+        import component
+        import mapping
+        import report_mapping
+        from metrics import run_metrics
+
+        redirect(client.requesting, url)
+        tables_path = os.path.join(data_dir, "out", "tables") + os.sep
+        mapping.DEFAULT_FILE_DESTINATION = report_mapping.DEFAULT_FILE_DESTINATION = tables_path
+
+        start = time.perf_counter()
+        component.Component().run()
+        elapsed = time.perf_counter() - start
+
+        totals = run_metrics.summary()["totals"]
+        return {"scenario": scenario, "seconds": elapsed, "rows": totals["rows_written"],
+                "rows_per_second": totals["rows_written"] / elapsed, "records": totals["records_parsed"],
+                "retries": totals["retries"], "mb_received": totals["bytes_received"] / 1024 / 1024}
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of component runs against the stand-in QuickBooks API")
+    parser.add_argument("--scenario", choices=["entities", "reports", "all"], default="all")
+    parser.add_argument("--records", type=int, default=5000, help="records of every entity")
+    parser.add_argument("--lines", type=int, default=3, help="lines of every record")
+    parser.add_argument("--report-rows", type=int, default=5000, help="data rows of every report")
+    parser.add_argument("--classes", type=int, default=10, help="number of Classes")
+    parser.add_argument("--latency", type=float, default=0.02, help="response delay in seconds")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="share of throttled requests")
+    parser.add_argument("--retry-after", type=int, default=None, help="Retry-After of throttled requests")
+    parser.add_argument("--fixtures", default=None, help="folder with recorded records and reports")
+    parser.add_argument("--workers", type=int, default=4, help="performance.max_workers")
+    parser.add_argument("--pagination", default="offset", help="performance.pagination")
+    parser.add_argument("--output-format", default="csv", help="destination.output_format")
+    parser.add_argument("--batch-requests", action="store_true", help="performance.batch_requests")
+    args = parser.parse_args()
+
+    scenarios = ["entities", "reports"] if args.scenario == "all" else [args.scenario]
+    results = []
+    with MockQuickBooks(records=args.records, lines=args.lines, report_rows=args.report_rows, classes=args.classes,
+                        latency=args.latency, rate_429=args.rate_429, retry_after=args.retry_after,
+                        fixtures=args.fixtures) as mock:
+        for scenario in scenarios:
+            mock.reset_counts()
+            result = run_isolated(run_component, scenario, mock.url, args)
+            counts = mock.counts()
+            result.update(requests=counts["requests"], throttled=counts["throttled"])
+            results.append(result)
+            print(json.dumps(counts["endpoints"]), file=sys.stderr)
+
+    print_results(results, [("scenario", "scenario", "{0}"), ("time [s]", "seconds", "{0:.2f}"),
+                            ("rows", "rows", "{0}"), ("rows/s", "rows_per_second", "{0:.0f}"),
+                            ("requests", "requests", "{0}"), ("throttled", "throttled", "{0}"),
+                            ("received [MB]", "mb_received", "{0:.1f}"), ("peak RSS [MB]", "peak_rss_mb", "{0:.1f}")])
+
+
+if __name__ == "__main__":
+    main()
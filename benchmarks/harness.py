@@ -0,0 +1,53 @@
+"""
+Helpers shared by the benchmarks run against the stand-in QuickBooks API
+"""
+import multiprocessing
+import resource
+import sys
+import traceback
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of the current process in MB
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def _run_child(queue, func, args):
+    try:
+        result = func(*args)
+        result["peak_rss_mb"] = peak_rss_mb()
+        queue.put(result)
+    except BaseException:
+        queue.put({"error": traceback.format_exc()})
+
+
+def run_isolated(func, *args):
+    """
+    Runs func(*args) in a forked process, so its peak RSS is measured alone
+    The stand-in server keeps running in the parent process, its threads are not measured.
+    Returns the dict returned by func extended with peak_rss_mb, raises RuntimeError if func failed.
+    """
+    context = multiprocessing.get_context("fork")
+    queue = context.Queue()
+    process = context.Process(target=_run_child, args=(queue, func, args))
+    process.start()
+    result = queue.get()
+    process.join()
+    if "error" in result:
+        raise RuntimeError(result["error"])
+    return result
+
+
+def print_results(results, columns):
+    """
+    Prints results as a table, columns are (title, key, format) tuples
+    """
+    rows = [[format_.format(result[key]) for _, key, format_ in columns] for result in results]
+    widths = [max([len(title)] + [len(row[index]) for row in rows]) for index, (title, _, _) in enumerate(columns)]
+    print("  ".join(title.rjust(width) for (title, _, _), width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(value.rjust(width) for value, width in zip(row, widths)))
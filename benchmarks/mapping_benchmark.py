@@ -0,0 +1,119 @@
+"""
+Benchmark of Mapping and ReportMapping on responses of the stand-in QuickBooks API
+
+Fetches every entity with QuickbooksClient page by page into Mapping, and every report to a temporary file
+parsed by ReportMapping, the way the component does. Prints records fetched, rows written, parsing throughput
+(records parsed per second of parsing and writing), overall rows per second, requests and peak RSS of every case.
+Every case is run in a forked process, the stand-in server runs in the main process.
+
+Usage: python benchmarks/mapping_benchmark.py [--records 10000] [--report-rows 10000] [--latency 0.0]
+       [--workers 4] [--pagination offset] [--output-format csv]
+"""
+import argparse
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARKS_PATH)
+sys.path.insert(0, os.path.join(BENCHMARKS_PATH, "..", "src"))
+
+from harness import print_results, run_isolated  # noqa: E402
+from mock_server import MockQuickBooks, redirect  # noqa: E402
+
+COMPANY_ID = "1234567890"
+ENTITIES = ["Invoice", "Customer", "JournalEntry", "Item"]
+REPORTS = [
+    ("ProfitAndLoss", {"summarize_column_by": "Classes"}),
+    ("BalanceSheet", None),
+    ("GeneralLedger", None),
+    ("TransactionList", None)
+]
+
+
+def create_client(url, args):
+    import client
+
+    redirect(client.requesting, url)
+    expires_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
+    tokens = client.TokenManager("access", "refresh", "key", "secret", expires_at=expires_at)
+    return client.QuickbooksClient(COMPANY_ID, "access", "refresh", SimpleNamespace(appKey="key", appSecret="secret"),
+                                   False, max_workers=args.workers, token_manager=tokens, pagination=args.pagination)
+
+
+def run_case(kind, name, params, url, args):
+    out_dir = tempfile.mkdtemp(prefix="quickbooks-benchmark-")
+    try:
+        import mapping
+        import report_mapping
+        from metrics import run_metrics
+        from table_writer import OutputFormats
+
+        tables_path = os.path.join(out_dir, "tables") + os.sep
+        os.makedirs(tables_path)
+        mapping.DEFAULT_FILE_DESTINATION = report_mapping.DEFAULT_FILE_DESTINATION = tables_path
+        output_formats = OutputFormats(args.output_format)
+        quickbooks = create_client(url, args)
+        run_metrics.reset()
+
+        start = time.perf_counter()
+        if kind == "Mapping":
+            with mapping.Mapping(name, output_formats=output_formats) as writer:
+                quickbooks.fetch(name, False, None, None, writer=writer)
+        else:
+            quickbooks.report_request(name, "2024-01-01", "2024-12-31", params, stream=True)
+            paths = [(quickbooks.data, "accrual"), (quickbooks.data_2, "cash")] \
+                if name in quickbooks.reports_required_accounting_type else [(quickbooks.data, "")]
+            for path, accounting_type in paths:
+                try:
+                    report_mapping.ReportMapping(name, file_path=path, accounting_type=accounting_type,
+                                                 output_formats=output_formats)
+                finally:
+                    os.remove(path)
+        elapsed = time.perf_counter() - start
+
+        summary = run_metrics.summary()
+        totals = summary["totals"]
+        parsing_seconds = totals["parsing_seconds"]
+        return {"case": "{0} {1}".format(kind, name), "seconds": elapsed, "records": totals["records_parsed"],
+                "rows": totals["rows_written"], "rows_per_second": totals["rows_written"] / elapsed,
+                "parsed_per_second": totals["records_parsed"] / parsing_seconds if parsing_seconds else 0,
+                "requests": totals["requests"], "mb_written": totals["bytes_written"] / 1024 / 1024}
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of Mapping and ReportMapping")
+    parser.add_argument("--records", type=int, default=10000, help="records of every entity")
+    parser.add_argument("--lines", type=int, default=3, help="lines of every record")
+    parser.add_argument("--report-rows", type=int, default=10000, help="data rows of every report")
+    parser.add_argument("--classes", type=int, default=10, help="number of Classes")
+    parser.add_argument("--latency", type=float, default=0.0, help="response delay in seconds")
+    parser.add_argument("--fixtures", default=None, help="folder with recorded records and reports")
+    parser.add_argument("--workers", type=int, default=4, help="parallel requests of entity pages")
+    parser.add_argument("--pagination", default="offset", help="pagination of entity endpoints")
+    parser.add_argument("--output-format", default="csv", help="output format of the tables")
+    args = parser.parse_args()
+
+    cases = [("Mapping", entity, None) for entity in ENTITIES]
+    cases += [("ReportMapping", report, params) for report, params in REPORTS]
+    results = []
+    with MockQuickBooks(records=args.records, lines=args.lines, report_rows=args.report_rows, classes=args.classes,
+                        latency=args.latency, fixtures=args.fixtures) as mock:
+        for kind, name, params in cases:
+            results.append(run_isolated(run_case, kind, name, params, mock.url, args))
+
+    print_results(results, [("case", "case", "{0}"), ("time [s]", "seconds", "{0:.2f}"),
+                            ("records", "records", "{0}"), ("rows", "rows", "{0}"),
+                            ("parsed/s", "parsed_per_second", "{0:.0f}"), ("rows/s", "rows_per_second", "{0:.0f}"),
+                            ("requests", "requests", "{0}"), ("written [MB]", "mb_written", "{0:.1f}"),
+                            ("peak RSS [MB]", "peak_rss_mb", "{0:.1f}")])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,436 @@
+"""
+Local stand-in of the QuickBooks API for offline benchmarks
+
+Serves synthetic entity records generated from src/mappings.json, so every mapped column and nested table is filled,
+and synthetic reports: ProfitAndLoss (with a column per Class when summarized by Classes), BalanceSheet and other
+summary reports, GeneralLedger, TransactionList and ProfitAndLossDetail with transaction rows. Recorded payloads
+can be served instead from a fixtures folder: <Entity>.json with a list of records or a QueryResponse, whose records
+are repeated with new Ids, and <Report>.json with a report, which is served as it is.
+
+Supported requests: query (count, STARTPOSITION and Id cursor pagination), batch, cdc, reports and the OAuth token
+refresh. Responses are delayed by the latency and throttled (429) at the given rate.
+
+The clients are pointed to the server by redirect(session), which mounts a transport adapter rewriting QuickBooks
+URLs of the requests session. The async HTTP engine does not use the session and is not redirected.
+
+Usage: python benchmarks/mock_server.py [--port 8080] [--records 10000] [--latency 0.05] [--rate-429 0.01]
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import urllib.parse as url_parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from requests.adapters import HTTPAdapter
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC_PATH)
+
+from metrics import endpoint_label  # noqa: E402
+
+MAPPINGS_PATH = os.path.join(SRC_PATH, "mappings.json")
+QUICKBOOKS_HOSTS = ("https://quickbooks.api.intuit.com", "https://sandbox-quickbooks.api.intuit.com",
+                    "https://oauth.platform.intuit.com")
+# QuickBooks returns at most 1000 records per query, 100 if MAXRESULTS is not set
+MAX_RESULTS = 1000
+DEFAULT_MAX_RESULTS = 100
+TRANSACTION_REPORTS = ("GeneralLedger", "TransactionList", "ProfitAndLossDetail")
+TRANSACTION_COLUMNS = ("tx_date", "txn_type", "doc_num", "name", "memo", "account_name", "split_acc", "subt_nat_amount",
+                       "rbal_nat_amount", "klass_name", "dept_name", "is_cleared")
+ROWS_PER_SECTION = 50
+
+COUNT_QUERY = re.compile(r"select\s+count\(\*\)\s+from\s+(\w+)", re.IGNORECASE)
+SELECT_QUERY = re.compile(r"select\s+\*\s+from\s+(\w+)", re.IGNORECASE)
+ID_CURSOR = re.compile(r"Id\s*>\s*'(\d+)'", re.IGNORECASE)
+START_POSITION = re.compile(r"STARTPOSITION\s+(\d+)", re.IGNORECASE)
+MAX_RESULTS_CLAUSE = re.compile(r"MAXRESULTS\s+(\d+)", re.IGNORECASE)
+
+
+def sample_value(data_type, n):
+    """
+    Value of a mapped column of the declared type, as it comes in the JSON of the API
+    """
+    if data_type == "decimal":
+        return round(n * 1.37 % 10000, 2)
+    if data_type == "int":
+        return n % 100
+    if data_type == "bool":
+        return n % 2 == 0
+    if data_type == "date":
+        return (datetime.date(2024, 1, 1) + datetime.timedelta(days=n % 365)).isoformat()
+    if data_type == "datetime":
+        return "2024-01-{0:02d}T10:{1:02d}:00-08:00".format(n % 28 + 1, n % 60)
+    return "Value {0}".format(n)
+
+
+def sample_record(mapping, n, lines):
+    """
+    Record filling every column and nested table of the mapping
+    Nested tables named like Line or LinkedTxn are lists of the given number of lines, other nested tables objects.
+    """
+    record = {}
+    for path, column in mapping.items():
+        if column["type"] == "column":
+            value = sample_value(column["mapping"].get("dataType"), n)
+        elif path.endswith("Line") or path.endswith("Txn"):
+            value = [sample_record(column["tableMapping"], n * lines + line, lines) for line in range(lines)]
+        else:
+            value = sample_record(column["tableMapping"], n, lines)
+
+        words = path.split(".")
+        target = record
+        for word in words[:-1]:
+            target = target.setdefault(word, {})
+        target[words[-1]] = value
+    return record
+
+
+class MockQuickBooks:
+    """
+    Stand-in QuickBooks API server running in a background thread
+    records     - number of records of every entity, or dict of the number per entity, unlisted entities have 100
+    lines       - number of lines of nested list tables of every record
+    report_rows - number of data rows of every report
+    classes     - number of Classes, ProfitAndLoss summarized by Classes has a column per Class
+    latency     - seconds every response is delayed by
+    rate_429    - share of requests answered with 429 Too Many Requests
+    retry_after - Retry-After header of the 429 responses in seconds, not sent if None
+    fixtures    - folder with recorded entity records and reports served instead of the synthetic ones
+    """
+
+    def __init__(self, records=1000, lines=3, report_rows=1000, classes=10, latency=0.0, rate_429=0.0,
+                 retry_after=None, fixtures=None, port=0, seed=0):
+        self.records = records
+        self.lines = lines
+        self.report_rows = report_rows
+        self.classes = classes
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.fixtures = fixtures
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = {}  # number of requests per endpoint
+        self.throttled = {}  # number of 429 responses per endpoint
+        self.bytes_sent = 0
+
+        with open(MAPPINGS_PATH, 'r') as f:
+            self.mappings = json.load(f)
+        self.templates = {}
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self.handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="mock-quickbooks", daemon=True)
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{0}".format(self.server.server_port)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset_counts(self):
+        with self.lock:
+            self.requests = {}
+            self.throttled = {}
+            self.bytes_sent = 0
+
+    def counts(self):
+        """
+        Requests served since the last reset: totals and the number of requests per endpoint
+        """
+        with self.lock:
+            return {"requests": sum(self.requests.values()), "throttled": sum(self.throttled.values()),
+                    "bytes_sent": self.bytes_sent, "endpoints": dict(self.requests)}
+
+    def redirect(self, session):
+        """
+        Sends requests of the session to QuickBooks hosts to this server
+        """
+        redirect(session, self.url)
+
+    def entity_count(self, entity):
+        if isinstance(self.records, dict):
+            return self.records.get(entity, 100)
+        if entity == "Class":
+            return self.classes
+        if entity == "Preferences":
+            return 1
+        return self.records
+
+    def fixture(self, name):
+        if not self.fixtures:
+            return None
+        path = os.path.join(self.fixtures, name + ".json")
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def entity_record(self, entity, record_id):
+        """
+        Record of the entity with the given Id, recorded records are repeated with new Ids
+        """
+        if entity not in self.templates:
+            recorded = self.fixture(entity)
+            if isinstance(recorded, dict):
+                recorded = recorded.get("QueryResponse", recorded).get(entity, [])
+            self.templates[entity] = recorded or None
+
+        templates = self.templates[entity]
+        if templates:
+            record = dict(templates[record_id % len(templates)])
+        else:
+            record = sample_record(self.mappings.get(entity, {}), record_id, self.lines)
+        record["Id"] = str(record_id)
+        record["MetaData"] = {"CreateTime": "2024-01-01T00:00:00-08:00",
+                              "LastUpdatedTime": sample_value("datetime", record_id)}
+        if entity == "Class":
+            record["Name"] = "Class {0}".format(record_id)
+        return record
+
+    def query(self, query):
+        match = COUNT_QUERY.search(query)
+        if match:
+            return {"QueryResponse": {"totalCount": self.entity_count(match.group(1))}}
+
+        match = SELECT_QUERY.search(query)
+        if not match:
+            raise ValueError("Unsupported query: {0}".format(query))
+        entity = match.group(1)
+
+        cursor = ID_CURSOR.search(query)
+        start = START_POSITION.search(query)
+        max_results = MAX_RESULTS_CLAUSE.search(query)
+        first_id = int(cursor.group(1)) + 1 if cursor else int(start.group(1)) if start else 1
+        max_results = min(int(max_results.group(1)), MAX_RESULTS) if max_results else DEFAULT_MAX_RESULTS
+        last_id = min(self.entity_count(entity), first_id + max_results - 1)
+
+        records = [self.entity_record(entity, record_id) for record_id in range(first_id, last_id + 1)]
+        if not records:
+            return {"QueryResponse": {}}
+        return {"QueryResponse": {entity: records, "startPosition": first_id, "maxResults": len(records)}}
+
+    def batch(self, body):
+        items = []
+        for item in body.get("BatchItemRequest", []):
+            items.append({"bId": item["bId"], **self.query(item["Query"])})
+        return {"BatchItemResponse": items}
+
+    def cdc(self, params):
+        entities = params.get("entities", [""])[0].split(",")
+        response = {}
+        for entity in entities:
+            count = min(self.entity_count(entity), MAX_RESULTS)
+            response[entity] = [self.entity_record(entity, record_id) for record_id in range(1, count + 1)]
+        return {"CDCResponse": [{"QueryResponse": [response]}]}
+
+    def report(self, name, params):
+        recorded = self.fixture(name)
+        if recorded is not None:
+            return recorded
+
+        header = {
+            "Time": "2024-02-01T00:00:00-08:00",
+            "ReportName": name,
+            "StartPeriod": params.get("start_date", ["2024-01-01"])[0],
+            "EndPeriod": params.get("end_date", ["2024-12-31"])[0],
+            "Currency": "USD",
+            "Option": [{"Name": "AccountingMethod", "Value": params.get("accounting_method", ["Accrual"])[0]}]
+        }
+        if name in TRANSACTION_REPORTS:
+            return self.transaction_report(header)
+        return self.summary_report(header, params.get("summarize_column_by", [""])[0] == "Classes")
+
+    def transaction_report(self, header):
+        """
+        Transaction level report with sections per account, like GeneralLedger or TransactionList
+        """
+        columns = [{"ColTitle": column, "ColType": column} for column in TRANSACTION_COLUMNS]
+        sections = []
+        for start in range(0, self.report_rows, ROWS_PER_SECTION):
+            rows = []
+            for n in range(start, min(start + ROWS_PER_SECTION, self.report_rows)):
+                col_data = [{"value": sample_value("date", n)}, {"value": "Invoice", "id": str(n)},
+                            {"value": str(1000 + n)}, {"value": "Customer {0}".format(n % 97), "id": str(n % 97)},
+                            {"value": "Memo of transaction {0}".format(n)},
+                            {"value": "Account {0}".format(start), "id": str(start)},
+                            {"value": "Accounts Receivable", "id": "84"},
+                            {"value": "{0:.2f}".format(n * 1.37 % 10000)}, {"value": "{0:.2f}".format(n * 2.11)},
+                            {"value": "Class {0}".format(n % self.classes + 1)}, {"value": ""}, {"value": "Uncleared"}]
+                rows.append({"type": "Data", "ColData": col_data})
+            sections.append({"type": "Section",
+                             "Header": {"ColData": [{"value": "Account {0}".format(start), "id": str(start)}]},
+                             "Rows": {"Row": rows},
+                             "Summary": {"ColData": [{"value": "Total for Account {0}".format(start)}]}})
+        return {"Header": header, "Columns": {"Column": columns}, "Rows": {"Row": sections}}
+
+    def summary_report(self, header, by_class=False):
+        """
+        Summary report with account rows in sections, like ProfitAndLoss or BalanceSheet
+        Summarized by Classes, the report has an amount column per Class and a Total column.
+        """
+        titles = ["Class {0}".format(n + 1) for n in range(self.classes)] if by_class else []
+        columns = [{"ColTitle": "", "ColType": "Account"}]
+        columns += [{"ColTitle": title, "ColType": "Money"} for title in titles + ["Total"]]
+        if by_class:
+            header = dict(header, SummarizeColumnsBy="Classes")
+
+        def amounts(n):
+            values = [n * (column + 1) * 0.37 % 1000 for column in range(len(titles))]
+            return [{"value": "{0:.2f}".format(value)} for value in values + [sum(values) or n * 0.37]]
+
+        sections = []
+        for start in range(0, self.report_rows, ROWS_PER_SECTION):
+            rows = [{"type": "Data", "ColData": [{"value": "Account {0}".format(n), "id": str(n)}] + amounts(n)}
+                    for n in range(start, min(start + ROWS_PER_SECTION, self.report_rows))]
+            sections.append({"type": "Section",
+                             "group": "Group{0}".format(start),
+                             "Header": {"ColData": [{"value": "Section {0}".format(start)}]},
+                             "Rows": {"Row": rows},
+                             "Summary": {"ColData": [{"value": "Total Section {0}".format(start)}] + amounts(start)}})
+        sections.append({"group": "NetIncome", "type": "Section",
+                         "Summary": {"ColData": [{"value": "Net Income"}] + amounts(self.report_rows)}})
+        return {"Header": header, "Columns": {"Column": columns}, "Rows": {"Row": sections}}
+
+    def respond(self, method, path, query, body=None):
+        """
+        Returns status, headers and JSON body of the response to the request
+        """
+        label = endpoint_label(path + "?" + query)
+        with self.lock:
+            self.requests[label] = self.requests.get(label, 0) + 1
+            throttled = self.random.random() < self.rate_429
+            if throttled:
+                self.throttled[label] = self.throttled.get(label, 0) + 1
+
+        if throttled:
+            headers = {"Retry-After": str(self.retry_after)} if self.retry_after is not None else {}
+            return 429, headers, {"Fault": {"Error": [{"Message": "message=ThrottleExceeded", "code": "3001"}],
+                                            "type": "ThrottleExceeded"}}
+
+        params = url_parse.parse_qs(query)
+        if path.endswith("/tokens/bearer"):
+            return 200, {}, {"access_token": "access", "refresh_token": "refresh", "expires_in": 3600}
+        if path.endswith("/query"):
+            return 200, {}, self.query(params.get("query", [""])[0])
+        if path.endswith("/batch") and method == "POST":
+            return 200, {}, self.batch(body or {})
+        if path.endswith("/cdc"):
+            return 200, {}, self.cdc(params)
+        if "/reports/" in path:
+            return 200, {}, self.report(path.rsplit("/", 1)[-1], params)
+        return 404, {}, {"Fault": {"Error": [{"Message": "Unknown endpoint {0}".format(path)}]}}
+
+    def handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def handle_request(self, method):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                if body and "json" in (self.headers.get("Content-Type") or ""):
+                    body = json.loads(body)
+
+                parsed = url_parse.urlsplit(self.path)
+                try:
+                    status, headers, payload = mock.respond(method, parsed.path, parsed.query, body)
+                except ValueError as e:
+                    status, headers, payload = 400, {}, {"Fault": {"Error": [{"Message": str(e)}]}}
+
+                if mock.latency:
+                    time.sleep(mock.latency)
+
+                content = json.dumps(payload).encode("utf-8")
+                with mock.lock:
+                    mock.bytes_sent += len(content)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def do_GET(self):
+                self.handle_request("GET")
+
+            def do_POST(self):
+                self.handle_request("POST")
+
+        return Handler
+
+
+class RedirectAdapter(HTTPAdapter):
+    """
+    Transport adapter sending the requests to the stand-in server instead of the host of their URL
+    """
+
+    def __init__(self, target):
+        super().__init__()
+        self.target = url_parse.urlsplit(target)
+
+    def send(self, request, **kwargs):
+        parsed = url_parse.urlsplit(request.url)
+        request.url = url_parse.urlunsplit((self.target.scheme, self.target.netloc, parsed.path, parsed.query,
+                                            parsed.fragment))
+        return super().send(request, **kwargs)
+
+
+def redirect(session, url):
+    """
+    Sends requests of the session to QuickBooks hosts to the server at the url, e.g. from a forked benchmark process
+    """
+    adapter = RedirectAdapter(url)
+    for host in QUICKBOOKS_HOSTS:
+        session.mount(host, adapter)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stand-in QuickBooks API server")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--records", type=int, default=1000, help="records of every entity")
+    parser.add_argument("--lines", type=int, default=3, help="lines of every record")
+    parser.add_argument("--report-rows", type=int, default=1000, help="data rows of every report")
+    parser.add_argument("--classes", type=int, default=10, help="number of Classes")
+    parser.add_argument("--latency", type=float, default=0.0, help="response delay in seconds")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="share of throttled requests")
+    parser.add_argument("--retry-after", type=int, default=None, help="Retry-After of throttled requests")
+    parser.add_argument("--fixtures", default=None, help="folder with recorded records and reports")
+    args = parser.parse_args()
+
+    mock = MockQuickBooks(records=args.records, lines=args.lines, report_rows=args.report_rows, classes=args.classes,
+                          latency=args.latency, rate_429=args.rate_429, retry_after=args.retry_after,
+                          fixtures=args.fixtures, port=args.port)
+    print("Serving QuickBooks API at {0}/v3/company".format(mock.url))
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(mock.counts(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Benchmark of ReportMapping parsing on synthetic reports
+
+Parses ProfitAndLoss-like reports of growing size and prints run time and peak memory allocated while parsing
+and writing the output. Both should grow linearly with the number of rows.
+
+Usage: python benchmarks/report_mapping_benchmark.py [max_rows]
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import report_mapping  # noqa: E402
+from report_mapping import ReportMapping  # noqa: E402
+
+ROWS_PER_SECTION = 100
+SECTIONS_PER_GROUP = 10
+
+
+def synthetic_report(rows):
+    """
+    Report with Data rows nested in two levels of sections, each section ends with a Summary group
+    """
+
+    def data_row(n):
+        return {"type": "Data", "ColData": [{"value": "Account {0}".format(n), "id": str(n)},
+                                            {"value": "{0:.2f}".format(n * 1.5)}]}
+
+    def section(name, inner_rows):
+        return {"type": "Section",
+                "Header": {"ColData": [{"value": name}, {"value": ""}]},
+                "Rows": {"Row": inner_rows},
+                "Summary": {"ColData": [{"value": "Total " + name}, {"value": "0.00"}]}}
+
+    sections = []
+    for n in range(0, rows, ROWS_PER_SECTION):
+        inner_rows = [data_row(i) for i in range(n, min(n + ROWS_PER_SECTION, rows))]
+        inner_rows.append({"type": "Section", "group": "Group{0}".format(n),
+                           "Summary": {"ColData": [{"value": "Total {0}".format(n)}, {"value": "1.00"}]}})
+        sections.append(section("Section {0}".format(n), inner_rows))
+
+    groups = [section("Group {0}".format(n), sections[n:n + SECTIONS_PER_GROUP])
+              for n in range(0, len(sections), SECTIONS_PER_GROUP)]
+    groups.append({"group": "NetIncome", "ColData": [{"value": "Net Income"}, {"value": "100.00"}]})
+
+    return {"Header": {"Time": "2024-02-01T00:00:00-08:00", "ReportName": "ProfitAndLoss",
+                       "StartPeriod": "2024-01-01", "EndPeriod": "2024-01-31", "Currency": "USD"},
+            "Columns": {"Column": [{"ColTitle": "", "ColType": "Account"}, {"ColTitle": "Total", "ColType": "Money"}]},
+            "Rows": {"Row": groups}}
+
+
+def run(rows):
+    report = synthetic_report(rows)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    ReportMapping(endpoint="ProfitAndLoss", data=report)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return elapsed, peak
+
+
+def main():
+    max_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        report_mapping.DEFAULT_FILE_DESTINATION = out_dir + os.sep
+
+        print("{0:>10} {1:>10} {2:>14} {3:>12} {4:>14}".format("rows", "time [s]", "us per row", "peak [MB]",
+                                                               "bytes per row"))
+        rows = max_rows // 8
+        while rows <= max_rows:
+            elapsed, peak = run(rows)
+            print("{0:>10} {1:>10.2f} {2:>14.2f} {3:>12.1f} {4:>14.0f}".format(
+                rows, elapsed, elapsed / rows * 1_000_000, peak / 1024 / 1024, peak / rows))
+            rows *= 2
+
+
+if __name__ == "__main__":
+    main()
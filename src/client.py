@@ -1,37 +1,457 @@
+import datetime
+import itertools
 import json
 import logging
+import os
+import random
+import re
+import tempfile
+import threading
+import time
 import requests
-import dateparser
 import urllib.parse as url_parse
 from requests.auth import HTTPBasicAuth
-from typing import Tuple
+from collections import deque
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
 from keboola.component.base import ComponentBase  # noqa
 import backoff
 from requests.exceptions import HTTPError
-from mapping import Mapping
+
+from metrics import run_metrics
+from response_cache import MAX_BODY_SIZE, cache_ttl, listing_ttl
 
 requesting = requests.Session()
+CHUNK_SIZE = 1024 * 1024
+
+# QuickBooks throttles every company (realm) at 500 requests per minute
+REQUESTS_PER_MINUTE = 500
+REQUESTS_BURST = 10
+# QuickBooks allows at most 10 concurrent requests per company, however many threads send them
+MAX_CONCURRENT_REQUESTS = 10
+# (connect, read) timeout in seconds, large reports may take minutes to generate
+REQUEST_TIMEOUT = (10, 300)
+MAX_RETRIES = 5
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# offset     - records are counted first and pages are requested by STARTPOSITION in parallel
+# short_page - pages are requested by STARTPOSITION until a page is not full, no count request is needed
+# keyset     - pages are requested by Id cursor (WHERE Id > '<last Id>' ORDERBY Id) until a page is not full
+PAGINATION_MODES = ("offset", "short_page", "keyset")
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+# Maximum number of queries in one request to the batch endpoint
+BATCH_MAX_ITEMS = 30
+ISO_DATE = re.compile(r"\d{4}-\d{2}-\d{2}")
 
 
 class QuickBooksClientException(Exception):
     pass
 
 
+class TokenBucket:
+    """
+    Thread-safe token bucket allowing rate requests per second on average and bursts of capacity requests
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """
+        Takes one token, waits until a token is available
+        """
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        Empties the bucket, so no token is available for the given number of seconds
+        """
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+
+class HeldResponse:
+    """
+    Stream response holding its slot among the concurrent requests of the company until it is closed
+    """
+
+    def __init__(self, response, release):
+        self._response = response
+        self._release = release
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def __bool__(self):
+        return bool(self._response)
+
+    def close(self):
+        try:
+            self._response.close()
+        finally:
+            if self._release is not None:
+                self._release()
+                self._release = None
+
+
+class RequestScheduler:
+    """
+    Sends requests of one company to the QuickBooks API
+    Requests are throttled by a token bucket shared by all clients of the company and at most max_concurrent
+    requests of the company are in flight at once, however the callers nest their thread pools. Throttled (429),
+    failed (5xx) and timed out requests are retried with jittered exponential backoff or after Retry-After.
+    """
+
+    _schedulers = {}
+    _schedulers_lock = threading.Lock()
+
+    def __init__(self, requests_per_minute=REQUESTS_PER_MINUTE, burst=REQUESTS_BURST, timeout=REQUEST_TIMEOUT,
+                 max_retries=MAX_RETRIES, max_concurrent=MAX_CONCURRENT_REQUESTS):
+        self.bucket = TokenBucket(requests_per_minute / 60, burst)
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.timeout = timeout
+        self.max_retries = max_retries
+
+    @classmethod
+    def for_company(cls, company_id):
+        """
+        Returns the scheduler of the company, it is created on first use
+        """
+        with cls._schedulers_lock:
+            if company_id not in cls._schedulers:
+                cls._schedulers[company_id] = cls()
+            return cls._schedulers[company_id]
+
+    @staticmethod
+    def backoff_delay(attempt):
+        """
+        Exponential backoff with full jitter
+        """
+        return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+    @staticmethod
+    def retry_after(response):
+        """
+        Seconds to wait from the Retry-After header, given either in seconds or as HTTP date
+        Returns None if the header is missing or invalid.
+        """
+        value = response.headers.get("Retry-After")
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if retry_at.tzinfo is None:
+            # Dates with -0000 zone are returned naive, they are in UTC
+            retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+        return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        """
+        Sends the request, retries it on throttling, server errors and connection errors
+        Only read requests are sent, so they are safe to be retried.
+        Returns the response, raises QuickBooksClientException once the retries are exhausted.
+        Every attempt takes one of the slots of the company, stream response keeps it until the response is closed,
+        so the body is downloaded within the limit as well. The slot is not held while waiting for a retry.
+        Every attempt is recorded in run_metrics with the time until the response headers were received.
+        """
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                run_metrics.record_retry(url)
+            self.bucket.acquire()
+            self.slots.acquire()
+            held = False
+            try:
+                started = time.monotonic()
+                try:
+                    response = requesting.request(method, url, timeout=self.timeout, **kwargs)
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    run_metrics.record_request(url, time.monotonic() - started)
+                    if attempt == self.max_retries:
+                        raise QuickBooksClientException(f"Request to {url} failed after {attempt + 1} attempts: "
+                                                        f"{e}") from e
+                    delay = self.backoff_delay(attempt)
+                    logging.warning(f"Request failed: {e}, retrying in {delay:.1f} s.")
+                else:
+                    run_metrics.record_request(url, time.monotonic() - started, response.status_code)
+                    if response.status_code not in RETRY_STATUS_CODES:
+                        if kwargs.get("stream"):
+                            held = True
+                            return HeldResponse(response, self.slots.release)
+                        return response
+                    if attempt == self.max_retries:
+                        raise QuickBooksClientException(f"Request to {url} failed after {attempt + 1} attempts with "
+                                                        f"status {response.status_code}: {response.text}")
+                    delay = self.retry_after(response)
+                    if delay is None:
+                        delay = self.backoff_delay(attempt)
+                    if response.status_code == 429:
+                        # Other threads of the company wait as well
+                        self.bucket.pause(delay)
+                    response.close()
+                    logging.warning(f"Request returned status {response.status_code}, retrying in {delay:.1f} s.")
+            finally:
+                if not held:
+                    self.slots.release()
+            time.sleep(delay)
+
+
+def set_http_engine(engine):
+    """
+    Sends the API requests through the engine instead of the requests session
+    engine - object with the request() method of requests.Session, e.g. http_engine.AsyncEngine
+    """
+    global requesting
+    requesting = engine
+
+
+def ordered_map(func, items, max_workers=1):
+    """
+    Applies func to every item using a pool of max_workers threads and yields the results in the order of items.
+    At most max_workers * 2 calls are in flight at once, so finished results never pile up in memory.
+    """
+    if max_workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    pending = deque()
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= max_workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def parse_timestamp(value):
+    """
+    Parses QuickBooks ISO 8601 timestamp, e.g. 2015-07-24T10:48:27-07:00, into timezone aware datetime
+    """
+    return datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def parse_date(value):
+    """
+    Parses date of the report request: YYYY-MM-DD (a time part is ignored), PrevMonthStart or PrevMonthEnd
+    Other formats are parsed by dateparser, which is imported only then, since its import takes hundreds of ms.
+    """
+    value = value.strip()
+    try:
+        if ISO_DATE.match(value):
+            return datetime.date.fromisoformat(value[:10])
+    except ValueError as e:
+        raise QuickBooksClientException(f"Date {value} is invalid: {e}") from e
+
+    prev_month_end = datetime.date.today().replace(day=1) - datetime.timedelta(days=1)
+    if value == "PrevMonthStart":
+        return prev_month_end.replace(day=1)
+    if value == "PrevMonthEnd":
+        return prev_month_end
+
+    import dateparser
+    parsed = dateparser.parse(value)
+    if parsed is None:
+        raise QuickBooksClientException(f"Date {value} is invalid. Valid formats are: PrevMonthStart, PrevMonthEnd "
+                                        f"or YYYY-MM-DD")
+    return parsed.date()
+
+
+def split_date_range(start_date, end_date, chunk_size):
+    """
+    Splits the date range into windows aligned to calendar days, weeks (Monday to Sunday) or months
+    Returns list of (start, end) date tuples, both inclusive.
+    """
+    if chunk_size not in ("day", "week", "month"):
+        raise QuickBooksClientException(f"Unknown report chunk size: {chunk_size}. Valid values are: day, week, month")
+
+    windows = []
+    window_start = start_date
+    while window_start <= end_date:
+        if chunk_size == "day":
+            window_end = window_start
+        elif chunk_size == "week":
+            window_end = window_start + datetime.timedelta(days=6 - window_start.weekday())
+        else:
+            next_month = (window_start.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+            window_end = next_month - datetime.timedelta(days=1)
+        window_end = min(window_end, end_date)
+        windows.append((window_start, window_end))
+        window_start = window_end + datetime.timedelta(days=1)
+    return windows
+
+
+class TokenManager:
+    """
+    OAuth tokens shared by all clients of a company
+    Access token is refreshed only when it is about to expire or the API rejects it, on_refresh is called
+    with the manager after every refresh, outside of the lock of the tokens.
+    """
+
+    # Access token is refreshed when it expires in less than this
+    expiry_margin = datetime.timedelta(minutes=5)
+
+    def __init__(self, access_token, refresh_token, app_key, app_secret, expires_at=None, on_refresh=None):
+        """
+        expires_at  - timezone aware expiration of the access token, the token is refreshed before the first
+                      request if it is not known
+        """
+        self.access_token = access_token
+        self.refresh_token = refresh_token
+        self.app_key = app_key
+        self.app_secret = app_secret
+        self.expires_at = expires_at
+        self.on_refresh = on_refresh
+        # The current access token was refreshed because the previous one was rejected
+        self.refreshed_on_reject = False
+        self._lock = threading.Lock()
+        self._on_refresh_lock = threading.Lock()
+
+    def get_access_token(self):
+        """
+        Returns valid access token, refreshing it first if it is about to expire
+        """
+        refreshed = False
+        with self._lock:
+            now = datetime.datetime.now(datetime.timezone.utc)
+            if self.expires_at is None or now >= self.expires_at - self.expiry_margin:
+                self.refresh()
+                refreshed = True
+            access_token = self.access_token
+
+        if refreshed:
+            self.notify_refresh()
+        return access_token
+
+    def reject(self, access_token):
+        """
+        Handles the access token rejected by the API
+        Returns True if the request should be retried with a new token, False if the token was already refreshed
+        because its predecessor was rejected, so the authorization is invalid. Tokens refreshed before their expiry
+        are refreshed once more when rejected.
+        """
+        with self._lock:
+            if access_token != self.access_token:
+                # Another client has already refreshed the token
+                return True
+            if self.refreshed_on_reject:
+                return False
+            self.refresh()
+            self.refreshed_on_reject = True
+
+        self.notify_refresh()
+        return True
+
+    def refresh(self):
+        """
+        Get a new access token with refresh token.
+        The caller holds the lock of the tokens and calls notify_refresh() after releasing it.
+        """
+        try:
+            results = self.refresh_request()
+        except HTTPError as e:
+            raise QuickBooksClientException(e) from e
+
+        self.access_token = results["access_token"]
+        self.refresh_token = results["refresh_token"]
+        self.expires_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
+            seconds=int(results.get("expires_in", 3600)))
+        self.refreshed_on_reject = False
+        run_metrics.record_refresh()
+
+    def notify_refresh(self):
+        """
+        Calls on_refresh, e.g. saving the tokens using Keboola API, without blocking the requests of other threads
+        Calls are serialized, so the tokens are saved one by one.
+        """
+        if self.on_refresh:
+            with self._on_refresh_lock:
+                self.on_refresh(self)
+
+    @backoff.on_exception(backoff.expo, HTTPError, max_tries=3)
+    def refresh_request(self):
+        logging.info("Refreshing Access Token")
+
+        url = "https://oauth.platform.intuit.com/oauth2/v1/tokens/bearer"
+        param = {
+            "grant_type": "refresh_token",
+            "refresh_token": self.refresh_token
+        }
+
+        r = requests.post(url, auth=HTTPBasicAuth(self.app_key, self.app_secret), data=param, timeout=REQUEST_TIMEOUT)
+        r.raise_for_status()
+
+        results = r.json()
+
+        if "error" in results:
+            raise QuickBooksClientException(f"Failed to refresh access token, please re-authorize credentials:"
+                                            f" {r.text}")
+        return results
+
+
 class QuickbooksClient:
     """
     QuickBooks Requests Handler
     """
 
-    def __init__(self, company_id, access_token, refresh_token, oauth, sandbox):
+    def __init__(self, company_id, access_token, refresh_token, oauth, sandbox, max_workers=1, token_manager=None,
+                 pagination="offset", cache=None):
+        """
+        token_manager - TokenManager shared with other clients of the company,
+                        a new one is created from access_token and refresh_token if it is not set
+        pagination    - pagination mode of entity endpoints, one of PAGINATION_MODES
+        cache         - ResponseCache the cacheable responses are served from, responses are not cached if not set
+        """
+        if pagination not in PAGINATION_MODES:
+            raise QuickBooksClientException(f"Unknown pagination mode: {pagination}. "
+                                            f"Valid values are: {', '.join(PAGINATION_MODES)}")
+
         self.count = None
         self.end_date = None
         self.start_date = None
-        self.maxresults = None
+        self.maxresults = 1000
         self.startposition = None
+        self.last_id = None
+        self.cursor = None
         self.report_api_bool = None
         self.endpoint = None
         self.data_2 = None
         self.data = None
+        self.changed_since = None
+        self.writer = None
+        self.listing = None
         self.app_key = oauth.appKey
         self.app_secret = oauth.appSecret
 
@@ -41,10 +461,14 @@ class QuickbooksClient:
             self.base_url = "https://sandbox-quickbooks.api.intuit.com/v3/company"
 
         # Parameters for request
-        self.access_token = access_token
-        self.refresh_token = refresh_token
-        self.access_token_refreshed = False
+        if token_manager is None:
+            token_manager = TokenManager(access_token, refresh_token, self.app_key, self.app_secret)
+        self.tokens = token_manager
         self.company_id = company_id
+        self.scheduler = RequestScheduler.for_company(company_id)
+        self.max_workers = max_workers
+        self.pagination = pagination
+        self.cache = cache
         self.reports_required_accounting_type = [
             "ProfitAndLoss",
             "ProfitAndLossDetail",
@@ -52,26 +476,80 @@ class QuickbooksClient:
             "BalanceSheet",
             "TrialBalance"
         ]
+        # Transaction level reports which can be fetched in date windows
+        self.reports_chunkable = [
+            "GeneralLedger",
+            "ProfitAndLossDetail",
+            "TransactionList"
+        ]
+        # Entities supported by the Change Data Capture endpoint
+        self.cdc_entities = [
+            "Account",
+            "Bill",
+            "BillPayment",
+            "Class",
+            "Customer",
+            "Department",
+            "Deposit",
+            "Invoice",
+            "Item",
+            "JournalEntry",
+            "Payment",
+            "Purchase",
+            "PurchaseOrder",
+            "Term",
+            "Transfer",
+            "Vendor"
+        ]
+        # CDC returns changes up to 30 days back and at most 1000 records of each entity per request
+        self.cdc_max_days = 30
+        self.cdc_max_results = 1000
+        # Small entities fetched with one query each in requests to the batch endpoint
+        self.batch_entities = [
+            "Term",
+            "TaxCode",
+            "TaxRate",
+            "Class",
+            "Department",
+            "Budget",
+            "Preferences"
+        ]
 
-    def get_new_refresh_token(self) -> Tuple[str, str]:
-        try:
-            self.refresh_access_token()
-        except Exception as e:
-            raise QuickBooksClientException(e) from e
+    @property
+    def access_token(self):
+        return self.tokens.access_token
 
-        return self.refresh_token, self.access_token
+    @property
+    def refresh_token(self):
+        return self.tokens.refresh_token
 
-    def fetch(self, endpoint, report_api_bool, start_date, end_date, query="", params=None):
+    def fetch(self, endpoint, report_api_bool, start_date, end_date, query="", params=None, changed_since=None,
+              writer=None, stream=False, resume=None):
         """
         Fetching results for the specified endpoint
+        changed_since - MetaData.LastUpdatedTime watermark, only records updated since then are fetched
+        writer        - Mapping the fetched records of entity endpoint are written to page by page,
+                        records are collected in data if it is not set
+        stream        - reports are saved to temporary JSON files and data contains their paths,
+                        the caller is responsible for removing the files
+        resume        - cursor of an interrupted extraction of the entity endpoint to continue from,
+                        cursor of the last processed page is kept in cursor
         """
         # Initializing Parameters
         self.endpoint = endpoint
         self.report_api_bool = report_api_bool
+        self.changed_since = changed_since
+        self.writer = writer
 
         # Pagination Parameters
         self.startposition = 1
+        self.last_id = None
+        self.cursor = None
         self.maxresults = 1000
+        if resume:
+            self.startposition = resume.get("startposition", 1)
+            self.last_id = resume.get("last_id")
+            logging.info(f"Resuming {endpoint} extraction from {resume}")
         self.start_date = start_date
         self.end_date = end_date
 
@@ -89,7 +567,35 @@ class QuickbooksClient:
             else:
                 if not (self.start_date and self.end_date):
                     raise QuickBooksClientException(f"Start date and End date are required for {endpoint} reports.")
-                self.report_request(endpoint, start_date, end_date, params)
+                self.report_request(endpoint, start_date, end_date, params, stream)
+        else:
+            # Records of reference entities are cached as one listing, so the count and all the pages
+            # are always fetched together from the same snapshot
+            ttl = listing_ttl(endpoint) if self.cache is not None and not resume else None
+            if ttl:
+                listing_key = self.cache.key(self.company_id, endpoint, {"where": self.where_clause()})
+                cached = self.cache.get(listing_key)
+                if cached and cached.fresh:
+                    logging.debug(f"Serving {endpoint} records from the response cache.")
+                    self.process_page(json.loads(cached.body))
+                    return
+                self.listing = []
+
+            try:
+                self.entity_request()
+                if ttl:
+                    self.cache.put(listing_key, json.dumps(self.listing).encode("utf-8"), ttl)
+            finally:
+                self.listing = None
+
+    def entity_request(self):
+        """
+        Fetches records of the entity endpoint with the configured pagination
+        """
+        if self.pagination == "short_page":
+            self.short_page_request()
+        elif self.pagination == "keyset":
+            self.keyset_request()
         else:
             self.count = self.get_count()  # total count of records for pagination
             if self.count == 0:
@@ -99,33 +605,6 @@ class QuickbooksClient:
             else:
                 self.data_request()
 
-    @backoff.on_exception(backoff.expo, HTTPError, max_tries=3)
-    def refresh_access_token(self):
-        """
-        Get a new access token with refresh token.
-        Also saves the new token in statefile.
-        """
-        logging.info("Refreshing Access Token")
-
-        url = "https://oauth.platform.intuit.com/oauth2/v1/tokens/bearer"
-        param = {
-            "grant_type": "refresh_token",
-            "refresh_token": self.refresh_token
-        }
-
-        r = requests.post(url, auth=HTTPBasicAuth(self.app_key, self.app_secret), data=param)
-        r.raise_for_status()
-
-        results = r.json()
-
-        if "error" in results:
-            raise QuickBooksClientException(f"Failed to refresh access token, please re-authorize credentials:"
-                                            f" {r.text}")
-
-        self.access_token = results["access_token"]
-        self.refresh_token = results["refresh_token"]
-        self.access_token_refreshed = True
-
     def get_count(self):
         """
         Fetch the number of records for the specified endpoint
@@ -133,7 +612,7 @@ class QuickbooksClient:
 
         # Request Parameters
         endpoint = self.endpoint
-        url = "select count(*) from {0}".format(endpoint)
+        url = "select count(*) from {0}{1}".format(endpoint, self.where_clause())
         encoded_url = self.url_encode(url)
         count_url = "{0}/{1}/query?query={2}".format(
             self.base_url, self.company_id, encoded_url)
@@ -141,12 +620,43 @@ class QuickbooksClient:
         # Request the number of counts
         data = self._request(count_url)
 
-        total_counts = data["QueryResponse"]["totalCount"]
+        total_counts = data["QueryResponse"].get("totalCount", 0)
         logging.debug("Total Number of Records for {0}: {1}".format(
             endpoint, total_counts))
 
         return total_counts
 
+    def where_clause(self, after_id=None):
+        """
+        WHERE clause shared by the count and the data queries of the endpoint
+        after_id - Id cursor of keyset pagination, only records with greater Id are selected
+        """
+
+        return self.entity_where_clause(self.endpoint, self.changed_since, after_id)
+
+    @staticmethod
+    def entity_where_clause(endpoint, changed_since=None, after_id=None):
+        """
+        WHERE clause of the endpoint query selecting records updated since changed_since
+        """
+
+        conditions = []
+
+        # Custom query for Class endpoint
+        if endpoint == 'Class':
+            conditions.append("Active IN (true, false)")
+
+        # Records updated in the same second as the watermark are fetched again and upserted by primary key
+        if changed_since:
+            conditions.append("MetaData.LastUpdatedTime >= '{0}'".format(changed_since))
+
+        if after_id is not None:
+            conditions.append("Id > '{0}'".format(after_id))
+
+        if not conditions:
+            return ""
+        return " WHERE " + " AND ".join(conditions)
+
     @staticmethod
     def url_encode(query):
         """
@@ -155,104 +665,296 @@ class QuickbooksClient:
         out = url_parse.quote_plus(query)
         return out
 
-    def _request(self, url, params=None):
+    def _request(self, url, params=None, stream=False, method="GET", body=None):
         """
         Handles Request
+        stream - successful response is saved to a temporary file chunk by chunk and its path is returned
+        body   - JSON body of POST request
         """
         # add minorversion to params
         if not params:
             params = {}
         params["minorversion"] = 75
 
+        # Responses of reference entities and closed period reports are served from the cache if it is enabled
+        cache_key = cached = None
+        ttl = cache_ttl(url) if self.cache is not None else None
+        if ttl:
+            cache_key = self.cache.key(self.company_id, url, params)
+            cached = self.cache.get(cache_key)
+            if cached and cached.fresh:
+                logging.debug(f"Serving {url} from the response cache.")
+                return self.cached_result(cached.body, stream)
+
         results = None
         request_success = False
         while not request_success:
+            access_token = self.tokens.get_access_token()
             headers = {
-                "Authorization": "Bearer " + self.access_token,
+                "Authorization": "Bearer " + access_token,
                 "Accept": "application/json"
             }
+            if cached:
+                # Expired cached response is revalidated
+                if cached.etag:
+                    headers["If-None-Match"] = cached.etag
+                if cached.last_modified:
+                    headers["If-Modified-Since"] = cached.last_modified
             logging.debug(f'Requesting: {url} with params: {params}')
-            data = requesting.get(url, headers=headers, params=params)
-
-            try:
-                results = data.json()
-                logging.debug(f"Response: {results}")
-
-            except json.decoder.JSONDecodeError as e:
-                raise QuickBooksClientException(f"Cannot decode response: {data.text}") from e
-
-            if "fault" in results or "Fault" in results:
-                if not self.access_token_refreshed:
-                    self.refresh_access_token()
+            data = self.scheduler.request(method, url, headers=headers, params=params, stream=stream, json=body)
+
+            # Responses are closed on every path, so the connection, and the host slot of the async engine,
+            # is released also when the body of the stream response is not read (304, errors)
+            with closing(data):
+                if cached and data.status_code == 304:
+                    self.cache.touch(cache_key, ttl)
+                    return self.cached_result(cached.body, stream)
+
+                if stream and data.ok:
+                    file_path = self.save_response(data)
+                    run_metrics.record_bytes(url, os.path.getsize(file_path))
+                    if cache_key and os.path.getsize(file_path) <= MAX_BODY_SIZE:
+                        with open(file_path, 'rb') as f:
+                            self.cache.put(cache_key, f.read(), ttl, data.headers.get("ETag"),
+                                           data.headers.get("Last-Modified"))
+                    return file_path
+
+                run_metrics.record_bytes(url, len(data.content))
+                try:
+                    results = data.json()
+
+                except json.decoder.JSONDecodeError as e:
+                    raise QuickBooksClientException(f"Cannot decode response: {data.text}") from e
+
+                if "fault" in results or "Fault" in results:
+                    # Rejected token is refreshed, retried with the new token refreshed here or by another client
+                    if not self.tokens.reject(access_token):
+                        if data:
+                            error = data.json().get("fault").get("error")[0]
+                            if error:
+                                if error.get("message"):
+                                    raise QuickBooksClientException(f"Authorization failed. Please check Company ID "
+                                                                    f"and/or reauthorize the application: "
+                                                                    f"{error.get('message')}")
+                                else:
+                                    raise QuickBooksClientException(error)
+                            raise QuickBooksClientException(data.text)
+                        else:
+                            raise QuickBooksClientException(f"Client cannot fetch data from url {url}, please check "
+                                                            f"defined endpoints and company_id.")
+                elif stream:
+                    raise QuickBooksClientException(f"Client cannot fetch data from url {url}: {data.text}")
                 else:
-                    if data:
-                        error = data.json().get("fault").get("error")[0]
-                        if error:
-                            if error.get("message"):
-                                raise QuickBooksClientException(f"Authorization failed. Please check Company ID and/or "
-                                                                f"reauthorize the application: {error.get('message')}")
-                            else:
-                                raise QuickBooksClientException(error)
-                        raise QuickBooksClientException(data.text)
-                    else:
-                        raise QuickBooksClientException(f"Client cannot fetch data from url {url}, please check "
-                                                        f"defined endpoints and company_id.")
-            else:
-                request_success = True
+                    request_success = True
 
         if not results:
             raise QuickBooksClientException("Unable to fetch results.")
+        if cache_key:
+            self.cache.put(cache_key, data.content, ttl, data.headers.get("ETag"), data.headers.get("Last-Modified"))
         return results
 
+    @staticmethod
+    def cached_result(body, stream=False):
+        """
+        Result of the request from the cached response body, saved to a temporary JSON file for stream requests
+        """
+        if not stream:
+            return json.loads(body)
+
+        fd, path = tempfile.mkstemp(suffix=".json")
+        with os.fdopen(fd, 'wb') as f:
+            f.write(body)
+        return path
+
+    @staticmethod
+    def save_response(response):
+        """
+        Writes the response body to a temporary JSON file chunk by chunk, so its size does not affect memory usage
+        """
+        fd, path = tempfile.mkstemp(suffix=".json")
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+        logging.debug(f"Response saved to {path}.")
+        return path
+
     def data_request(self):
         """
         Handles Request Parameters and Pagination
+        Pages are fetched by up to max_workers threads and processed in their original order.
         """
 
         num_of_run = 0
+        startpositions = range(self.startposition, self.count + 1, self.maxresults)
 
-        while self.startposition <= self.count:
-            # Query Parameters
-            # Custom query for Class endpoint
-            if self.endpoint == 'Class':
+        pages = ordered_map(self.page_request, startpositions, self.max_workers)
+        for startposition, data in zip(startpositions, pages):
+            self.process_page(data, {"startposition": startposition + self.maxresults})
+            num_of_run += 1
 
-                query = "SELECT * FROM {0} WHERE Active IN (true, false) STARTPOSITION {1} MAXRESULTS {2}".format(
-                    self.endpoint, self.startposition, self.maxresults)
+        logging.debug("Number of Requests: {0}".format(num_of_run))
 
-            else:
+    def short_page_request(self):
+        """
+        Pagination without counting the records, pages are fetched until a page is not full
+        The first page is fetched alone, so endpoints fitting into one page need a single request.
+        The following pages are fetched by up to max_workers threads, pages requested past the last one are discarded.
+        """
 
-                query = "SELECT * FROM {0} STARTPOSITION {1} MAXRESULTS {2}".format(
-                    self.endpoint, self.startposition, self.maxresults)
+        data = self.page_request(self.startposition)
+        self.process_page(data, {"startposition": self.startposition + self.maxresults})
+        num_of_run = 1
 
-            logging.debug("Request Query: {0}".format(query))
-            encoded_query = self.url_encode(query)
-            url = "{0}/{1}/query?query={2}".format(
-                self.base_url, self.company_id, encoded_query)
+        if len(data) == self.maxresults:
+            startpositions = itertools.count(self.startposition + self.maxresults, self.maxresults)
+            with closing(ordered_map(self.page_request, startpositions, self.max_workers)) as pages:
+                for data in pages:
+                    self.process_page(data, {"startposition": self.startposition + (num_of_run + 1) * self.maxresults})
+                    num_of_run += 1
+                    if len(data) < self.maxresults:
+                        break
 
-            # Requests and concatenating results into class's data variable
-            results = self._request(url)
+        elif not data:
+            logging.info("There are no returns for {0}".format(self.endpoint))
 
-            # If API returns error, raise exception and terminate application
-            if "fault" in results or "Fault" in results:
-                raise QuickBooksClientException(results)
+        logging.debug("Number of Requests: {0}".format(num_of_run))
 
-            data = results["QueryResponse"][self.endpoint]
+    def keyset_request(self):
+        """
+        Pagination by Id cursor, pages are fetched one by one until a page is not full
+        Unlike deep STARTPOSITION offsets, every page takes the same time and records changed during the scan
+        are neither skipped nor duplicated.
+        """
 
-            # Concatenate with exist extracted data
-            self.data = self.data + data
+        last_id = self.last_id
+        num_of_run = 0
 
-            if len(self.data) > 5_000:
-                logging.info(f"Writing {len(self.data)} rows from {self.endpoint} endpoint to output file.")
-                Mapping(endpoint=self.endpoint, data=self.data)
+        while True:
+            data = self.keyset_page_request(last_id)
+            if data:
+                last_id = data[-1]["Id"]
+            self.process_page(data, {"last_id": last_id})
+            num_of_run += 1
 
-                self.data = []
+            if len(data) < self.maxresults:
+                break
 
-            # Handling pagination parameters
-            self.startposition += self.maxresults
-            num_of_run += 1
+        if num_of_run == 1 and not data:
+            logging.info("There are no returns for {0}".format(self.endpoint))
 
         logging.debug("Number of Requests: {0}".format(num_of_run))
 
+    def process_page(self, data, cursor=None):
+        """
+        Writes records of the page to the writer, or collects them in data if there is no writer
+        cursor - position the extraction continues from after the page, kept in cursor once the page is written
+        """
+
+        if self.writer is not None:
+            self.writer.write(data)
+        else:
+            self.data.extend(data)
+        if self.listing is not None:
+            self.listing.extend(data)
+
+        self.cursor = cursor
+
+    def page_request(self, startposition):
+        """
+        Fetches one page of the endpoint starting at the given position
+        """
+
+        # Query Parameters
+        query = "SELECT * FROM {0}{1} STARTPOSITION {2} MAXRESULTS {3}".format(
+            self.endpoint, self.where_clause(), startposition, self.maxresults)
+
+        return self.query_request(query)
+
+    def keyset_page_request(self, last_id=None):
+        """
+        Fetches one page of the endpoint with records following the last_id cursor
+        """
+
+        query = "SELECT * FROM {0}{1} ORDERBY Id MAXRESULTS {2}".format(
+            self.endpoint, self.where_clause(after_id=last_id), self.maxresults)
+
+        return self.query_request(query)
+
+    def batch_request(self, endpoints):
+        """
+        Fetches the first page of several entity endpoints with one request to the batch endpoint
+        endpoints - MetaData.LastUpdatedTime watermark of every endpoint, None to fetch all its records
+        Returns records of every endpoint. Endpoints with a full page have more records, which have to be fetched
+        with regular queries.
+        """
+
+        if len(endpoints) > BATCH_MAX_ITEMS:
+            raise QuickBooksClientException(f"At most {BATCH_MAX_ITEMS} queries can be sent in one batch request.")
+
+        batch_items = []
+        for endpoint, changed_since in endpoints.items():
+            query = "SELECT * FROM {0}{1} STARTPOSITION 1 MAXRESULTS {2}".format(
+                endpoint, self.entity_where_clause(endpoint, changed_since), self.maxresults)
+            logging.debug("Batch Request Query: {0}".format(query))
+            batch_items.append({"bId": endpoint, "Query": query})
+
+        url = "{0}/{1}/batch".format(self.base_url, self.company_id)
+        results = self._request(url, method="POST", body={"BatchItemRequest": batch_items})
+
+        records = {}
+        for item in results.get("BatchItemResponse", []):
+            endpoint = item.get("bId")
+            if "Fault" in item or "fault" in item:
+                raise QuickBooksClientException(f"Batch query of {endpoint} failed: {item}")
+            records[endpoint] = item.get("QueryResponse", {}).get(endpoint, [])
+
+        missing = [endpoint for endpoint in endpoints if endpoint not in records]
+        if missing:
+            raise QuickBooksClientException(f"Batch response does not contain results of {missing}.")
+        return records
+
+    def query_request(self, query):
+        """
+        Requests the query and returns the records of the endpoint
+        """
+
+        logging.debug("Request Query: {0}".format(query))
+        encoded_query = self.url_encode(query)
+        url = "{0}/{1}/query?query={2}".format(
+            self.base_url, self.company_id, encoded_query)
+
+        results = self._request(url)
+
+        # If API returns error, raise exception and terminate application
+        if "fault" in results or "Fault" in results:
+            raise QuickBooksClientException(results)
+
+        return results["QueryResponse"].get(self.endpoint, [])
+
+    def cdc_request(self, entities, changed_since):
+        """
+        Fetches records of all the entities changed since changed_since with one Change Data Capture request
+        Deleted records are returned with status Deleted and only their Id and MetaData.
+        Returns dictionary of records per entity.
+        """
+
+        url = "{0}/{1}/cdc".format(self.base_url, self.company_id)
+        params = {
+            "entities": ",".join(entities),
+            "changedSince": changed_since
+        }
+        logging.debug("CDC request for {0} changed since {1}".format(entities, changed_since))
+
+        results = self._request(url, params)
+
+        changes = {entity: [] for entity in entities}
+        for cdc_response in results.get("CDCResponse", []):
+            for query_response in cdc_response.get("QueryResponse", []):
+                for entity in entities:
+                    changes[entity].extend(query_response.get(entity, []))
+
+        return changes
+
     def custom_request(self, input_query):
         """
         Handles Request Parameters and Pagination
@@ -278,9 +980,9 @@ class QuickbooksClient:
         # Concatenate with exist extracted data
         self.data = data
 
-    def report_request(self, endpoint, start_date, end_date, params=None):
+    def report_url(self, endpoint, start_date, end_date):
         """
-        API request for Report Endpoint
+        URL of the Report Endpoint for the date range
         """
 
         if start_date == "":
@@ -295,8 +997,8 @@ class QuickbooksClient:
                              "credit_amt "
         else:
 
-            startdate = (dateparser.parse(start_date)).strftime("%Y-%m-%d")
-            enddate = (dateparser.parse(end_date)).strftime("%Y-%m-%d")
+            startdate = parse_date(start_date).isoformat()
+            enddate = parse_date(end_date).isoformat()
 
             if startdate > enddate:
                 raise Exception(
@@ -317,18 +1019,74 @@ class QuickbooksClient:
 
         url = "{0}/{1}/reports/{2}{3}".format(self.base_url,
                                               self.company_id, endpoint, date_param)
+        return url
+
+    def report_request(self, endpoint, start_date, end_date, params=None, stream=False):
+        """
+        API request for Report Endpoint
+        """
+
+        url = self.report_url(endpoint, start_date, end_date)
         if endpoint in self.reports_required_accounting_type:
 
             accrual_url = url + "&accounting_method=Accrual"
             cash_url = url + "&accounting_method=Cash"
 
-            results = self._request(accrual_url, params)
-            self.data = results
+            # Both variants are requested at the same time, each thread gets its own copy of the params
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                accrual = executor.submit(self._request, accrual_url, dict(params or {}), stream)
+                cash = executor.submit(self._request, cash_url, dict(params or {}), stream)
 
-            results_2 = self._request(cash_url, params)
-            self.data_2 = results_2
+            # Result of the successful request is kept even if the other one failed, so its file can be removed
+            self.data = accrual.result() if accrual.exception() is None else None
+            self.data_2 = cash.result() if cash.exception() is None else None
+            for future in (accrual, cash):
+                if future.exception() is not None:
+                    raise future.exception()
 
         else:
 
-            results = self._request(url)
+            results = self._request(url, stream=stream)
             self.data = results
+
+    def accounting_reports_request(self, endpoint, start_date, end_date, params=None):
+        """
+        API requests for Accrual and Cash variants of the Report Endpoint
+        Fetched reports are returned instead of being stored in data, so it can be called from several threads.
+        Returns tuple (accrual report, cash report)
+        """
+
+        url = self.report_url(endpoint, start_date, end_date)
+        accrual = self._request(url + "&accounting_method=Accrual", dict(params or {}))
+        cash = self._request(url + "&accounting_method=Cash", dict(params or {}))
+        return accrual, cash
+
+    def report_chunks_request(self, endpoint, start_date, end_date, chunk_size, params=None):
+        """
+        API requests for Report Endpoint split into date windows of chunk_size (day, week or month)
+        The windows are fetched by up to max_workers threads, each response is saved to a temporary JSON file.
+        Yields tuples (window end date, accounting_type, file path) in the order of the windows, accounting_type
+        is empty for reports without accounting method. The caller is responsible for removing the files.
+        """
+
+        startdate = parse_date(start_date)
+        enddate = parse_date(end_date)
+
+        requests_to_send = []
+        for window_start, window_end in split_date_range(startdate, enddate, chunk_size):
+            url = self.report_url(endpoint, window_start.isoformat(), window_end.isoformat())
+            if endpoint in self.reports_required_accounting_type:
+                requests_to_send.append((window_end, "accrual", url + "&accounting_method=Accrual"))
+                requests_to_send.append((window_end, "cash", url + "&accounting_method=Cash"))
+            else:
+                requests_to_send.append((window_end, "", url))
+
+        logging.info(f"Fetching {endpoint} in {len(requests_to_send)} requests split by {chunk_size}.")
+
+        def fetch_chunk(request):
+            window_end, accounting_type, chunk_url = request
+            # Each thread needs its own copy of params, _request adds minorversion to them
+            chunk_params = dict(params) if params and accounting_type else None
+            return window_end, accounting_type, self._request(chunk_url, chunk_params, stream=True)
+
+        yield from ordered_map(fetch_chunk, requests_to_send, self.max_workers)
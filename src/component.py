@@ -2,14 +2,21 @@ import logging
 import csv
 import os
 import datetime
-from dateutil.relativedelta import relativedelta
+import shutil
 import requests
 import json
 import backoff
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 from mapping import Mapping
-from client import QuickbooksClient, QuickBooksClientException
-from report_mapping import ReportMapping
+from client import (BATCH_MAX_ITEMS, QuickbooksClient, QuickBooksClientException, TokenManager,
+                    ordered_map, parse_date, parse_timestamp, requesting, set_http_engine)
+from http_engine import AsyncEngine
+from metrics import run_metrics
+from report_mapping import ReportMapping, output_lock
+from response_cache import ResponseCache
+from table_writer import OutputFormats, output_path, table_writer
 
 from keboola.component.base import ComponentBase
 from keboola.component.exceptions import UserException  # noqa
@@ -28,8 +35,19 @@ KEY_START_DATE = 'start_date'
 KEY_END_DATE = 'end_date'
 KEY_GROUP_DESTINATION = 'destination'
 KEY_LOAD_TYPE = 'load_type'
+KEY_USE_CDC = 'use_cdc'
+KEY_OUTPUT_FORMAT = 'output_format'
+KEY_TABLE_OUTPUT_FORMATS = 'table_output_formats'
+KEY_TABLE = 'table'
 KEY_SUMMARIZE_COLUMN_BY = 'summarize_column_by'
 KEY_SANDBOX = 'sandbox'
+GROUP_PERFORMANCE = 'performance'
+KEY_MAX_WORKERS = 'max_workers'
+KEY_REPORT_CHUNK_SIZE = 'report_chunk_size'
+KEY_PAGINATION = 'pagination'
+KEY_RESPONSE_CACHE = 'response_cache'
+KEY_BATCH_REQUESTS = 'batch_requests'
+KEY_HTTP_ENGINE = 'http_engine'
 
 # list of mandatory parameters => if some is missing,
 # component will fail with readable message on initialization.
@@ -38,6 +56,17 @@ REQUIRED_PARAMETERS = [KEY_COMPANY_ID, KEY_ENDPOINTS, KEY_GROUP_DESTINATION]
 # QuickBooks Parameters
 BASE_URL = "https://quickbooks.api.intuit.com"
 
+# Response cache is saved to output files with the tag, the next run loads it if the tag is mapped to input files
+RESPONSE_CACHE_FILE = "quickbooks_response_cache.sqlite"
+RESPONSE_CACHE_TAG = "quickbooks_response_cache"
+# Metrics of the run are output as a file with the tag, so they can be compared across jobs
+METRICS_FILE = "quickbooks_metrics.json"
+METRICS_TAG = "quickbooks_metrics"
+
+# Watermarks are set to the start of the extraction minus the lookback, so the next run fetches again records
+# updated while the extraction was running and records whose LastUpdatedTime was set a bit before it was committed
+WATERMARK_LOOKBACK = datetime.timedelta(minutes=5)
+
 ALLOWED_BRANCHES = ["683762", "510379"]
 ALLOWED_PROJECTS = ["9525", "9382"]
 
@@ -47,8 +76,20 @@ class Component(ComponentBase):
     def __init__(self):
         super().__init__()
         self.incremental = None
+        self.incremental_entities = False
         self.refresh_token = None
         self.access_token = None
+        self.tokens = None
+        self.max_workers = 1
+        self.watermarks = {}
+        self.checkpoints = {}
+        self.use_cdc = False
+        self.report_chunk_size = None
+        self.pagination = "offset"
+        self.cache = None
+        self.batch_requests = False
+        self.http_engine = None
+        self.output_formats = OutputFormats()
 
         if self.environment_variables.branch_id not in ALLOWED_BRANCHES:
             raise UserException(f"This component uses Keboola API to store the statefile. "
@@ -62,12 +103,44 @@ class Component(ComponentBase):
 
     def run(self):
 
+        run_metrics.reset()
         sandbox = self.configuration.parameters.get(KEY_SANDBOX, False)
         start_date = None
         end_date = None
 
+        performance = self.configuration.parameters.get(GROUP_PERFORMANCE) or {}
+        self.max_workers = max(int(performance.get(KEY_MAX_WORKERS) or 1), 1)
+        logging.debug(f"Maximum number of parallel requests set to: {self.max_workers}")
+        self.report_chunk_size = performance.get(KEY_REPORT_CHUNK_SIZE) or None
+        logging.debug(f"Report chunk size set to: {self.report_chunk_size}")
+        self.pagination = performance.get(KEY_PAGINATION) or "offset"
+        logging.debug(f"Pagination set to: {self.pagination}")
+        if performance.get(KEY_RESPONSE_CACHE):
+            self.cache = self.open_response_cache()
+        self.batch_requests = bool(performance.get(KEY_BATCH_REQUESTS, False))
+        logging.debug(f"Batch requests set to: {self.batch_requests}")
+        http_engine = performance.get(KEY_HTTP_ENGINE) or "requests"
+        logging.debug(f"HTTP engine set to: {http_engine}")
+        if http_engine == "async":
+            self.http_engine = self.open_http_engine()
+        elif http_engine != "requests":
+            raise UserException(f"Unknown HTTP engine: {http_engine}. Valid values are: requests, async")
+        self.output_formats = self.get_output_formats()
+        # Entity endpoints are fetched incrementally only with incremental_load, even in the input table mode,
+        # where reports are always loaded incrementally
+        destination = self.configuration.parameters.get(KEY_GROUP_DESTINATION) or {}
+        self.incremental_entities = destination.get(KEY_LOAD_TYPE) == "incremental_load"
+        logging.debug(f"Incremental extraction of entity endpoints set to: {self.incremental_entities}")
+
         oauth = self.configuration.oauth_credentials
-        self.refresh_token, self.access_token = self.get_tokens(oauth)
+        self.refresh_token, self.access_token, expires_at = self.get_tokens(oauth)
+        # Tokens are shared by all the clients, new tokens are saved using API only if the refresh token changes
+        self.tokens = TokenManager(self.access_token, self.refresh_token, oauth.appKey, oauth.appSecret,
+                                   expires_at=expires_at,
+                                   on_refresh=None if sandbox else self.process_oauth_tokens)
+        self.watermarks = self.get_state_file().get("watermarks", {})
+        # Progress of extractions interrupted by a failure of the previous run
+        self.checkpoints = self.get_state_file().get("checkpoints", {})
 
         params_company_id = self.configuration.parameters.get(KEY_COMPANY_ID, None)
 
@@ -77,23 +150,41 @@ class Component(ComponentBase):
         else:
             cfg_table = False
 
-        if cfg_table:
-            self.validate_inputs(cfg_table, params_company_id)
-            try:
-                self.input_table_run(cfg_table, oauth, sandbox, params_company_id)
-            except QuickBooksClientException as e:
-                raise UserException(f"Component failed during run: {e}") from e
-        else:
-            try:
-                self.no_input_table_run(start_date, end_date, self.refresh_token, self.access_token, oauth, sandbox)
-            except QuickBooksClientException as e:
-                raise UserException(f"Component failed during run: {e}") from e
-
+        try:
+            if cfg_table:
+                self.validate_inputs(cfg_table, params_company_id)
+                try:
+                    self.input_table_run(cfg_table, oauth, sandbox, params_company_id)
+                except QuickBooksClientException as e:
+                    raise UserException(f"Component failed during run: {e}") from e
+            else:
+                try:
+                    self.no_input_table_run(start_date, end_date, oauth, sandbox)
+                except QuickBooksClientException as e:
+                    raise UserException(f"Component failed during run: {e}") from e
+        except Exception:
+            # The statefile is not saved when the job fails, the progress is saved using API instead
+            if self.checkpoints:
+                logging.info("Saving progress of the interrupted extractions, the next run will continue from it.")
+                self.save_new_oauth_tokens(self.tokens.refresh_token, self.tokens.access_token)
+            raise
+        finally:
+            if self.http_engine is not None:
+                self.close_http_engine()
+            self.save_run_metrics()
+
+        unused_tables = self.output_formats.unused_tables()
+        if unused_tables:
+            logging.warning(f"Output format is set for tables that were not output: {', '.join(unused_tables)}. "
+                            f"Nested tables are named with a hyphen, e.g. Invoice-Line.")
+
+        if self.cache is not None:
+            self.save_response_cache()
+
+        self.refresh_token, self.access_token = self.tokens.refresh_token, self.tokens.access_token
         self.write_state_file({
-            "tokens":
-                {"ts": datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
-                 "#refresh_token": self.refresh_token,
-                 "#access_token": self.access_token}
+            "tokens": self.tokens_state(self.refresh_token, self.access_token),
+            "watermarks": self.watermarks
         })
 
     @staticmethod
@@ -112,7 +203,7 @@ class Component(ComponentBase):
                     raise UserException(f"company_id from params: {params_company_id} does not match "
                                         f"with company_id provided in input table: {pk}.")
 
-    def no_input_table_run(self, start_date, end_date, refresh_token, access_token, oauth, sandbox):
+    def no_input_table_run(self, start_date, end_date, oauth, sandbox):
         logging.info("No input table detected. The component will run with parameters set in config.")
         self.validate_configuration_parameters(REQUIRED_PARAMETERS)
         params = self.configuration.parameters
@@ -144,20 +235,23 @@ class Component(ComponentBase):
             self.incremental = False
         logging.debug(f"Load type incremental set to: {self.incremental}")
 
+        self.use_cdc = bool(destination_params.get(KEY_USE_CDC, False))
+        if self.use_cdc and not self.incremental:
+            raise UserException("Change Data Capture can be used only with Incremental Load.")
+
         summarize_column_by = params.get(KEY_SUMMARIZE_COLUMN_BY) if params.get(
             KEY_SUMMARIZE_COLUMN_BY) else None
 
-        quickbooks_param = QuickbooksClient(company_id=company_id, refresh_token=refresh_token,
-                                            access_token=access_token, oauth=oauth, sandbox=sandbox)
-        if not sandbox:
-            self.process_oauth_tokens(quickbooks_param)
+        quickbooks_param = self.create_client(company_id, oauth, sandbox)
+
+        if self.use_cdc:
+            endpoints = self.process_cdc_endpoints(endpoints, quickbooks_param)
+        endpoints = self.process_batch_endpoints(endpoints, quickbooks_param)
 
         # Fetching reports for each configured endpoint
         for endpoint in endpoints:
             self.process_endpoint(endpoint, quickbooks_param, start_date, end_date, summarize_column_by)
 
-        self.refresh_token, self.access_token = quickbooks_param.refresh_token, quickbooks_param.access_token
-
     def input_table_run(self, cfg_table, oauth, sandbox, params_company_id: str):
         _endpoints = self.configuration.parameters.get("endpoints", [])
         with open(cfg_table.full_path, 'r') as csvfile:
@@ -165,56 +259,124 @@ class Component(ComponentBase):
             rows = list(reader)  # not memory efficient, but we are working with small input table
             if len(rows) == 0:
                 logging.info("No rows in input table detected, the component will process selected endpoints only.")
-                quickbooks_param = QuickbooksClient(company_id=params_company_id, refresh_token=self.refresh_token,
-                                                    access_token=self.access_token, oauth=oauth, sandbox=sandbox)
-                if not sandbox:
-                    self.process_oauth_tokens(quickbooks_param)
+                quickbooks_param = self.create_client(params_company_id, oauth, sandbox)
+                _endpoints = self.process_batch_endpoints(_endpoints, quickbooks_param)
                 for endpoint in _endpoints:
                     self.process_endpoint(endpoint, quickbooks_param, start_date=None, end_date=None,
                                           summarize_column_by=None)
-                    self.refresh_token, self.access_token = (
-                        quickbooks_param.refresh_token,
-                        quickbooks_param.access_token
-                    )
 
             else:
-                for row in rows:
-                    logging.debug(f"Processing row: {row}")
-                    company_id = row["PK"]
-                    endpoint = row["report"]
-                    start_date = row["start_date"]
-                    end_date = row["end_date"]
-                    self.incremental = True
-                    summarize_column_by = row["segment_data_by"] or None
-
-                    quickbooks_param = QuickbooksClient(company_id=company_id, refresh_token=self.refresh_token,
-                                                        access_token=self.access_token, oauth=oauth, sandbox=sandbox)
-
-                    if not sandbox:
-                        self.process_oauth_tokens(quickbooks_param)
-
-                    # Process endpoints defined in the input table
-                    self.process_endpoint(endpoint, quickbooks_param, start_date, end_date, summarize_column_by)
-                    self.refresh_token, self.access_token = (
-                        quickbooks_param.refresh_token,
-                        quickbooks_param.access_token
-                    )
+                self.incremental = True
+                self.process_input_rows(rows, oauth, sandbox)
 
                 # Also process endpoints from configuration
+                quickbooks_param = self.create_client(rows[-1]["PK"], oauth, sandbox)
+                _endpoints = self.process_batch_endpoints(_endpoints, quickbooks_param)
                 for endpoint in _endpoints:
                     self.process_endpoint(endpoint,
                                           quickbooks_param,
                                           start_date=None,
                                           end_date=None,
                                           summarize_column_by=None)
-                    self.refresh_token, self.access_token = (
-                        quickbooks_param.refresh_token,
-                        quickbooks_param.access_token
-                    )
-
-    def process_oauth_tokens(self, client) -> None:
-        """Uses Quickbooks client to get new tokens and saves them using API if they have changed since the last run."""
-        new_refresh_token, new_access_token = client.get_new_refresh_token()
+
+    def process_input_rows(self, rows, oauth, sandbox):
+        """
+        Processes rows of the input table grouped by company and report, up to max_workers reports at once.
+        Rows of the same report are processed one by one in the order of the input table, since tables of parsed
+        reports are rewritten by every row.
+        """
+        reports = {}
+        for row in rows:
+            reports.setdefault((row["PK"], row["report"]), []).append(row)
+        logging.info(f"Processing {len(rows)} input table rows of {len(reports)} reports.")
+
+        def process_report_rows(report_rows):
+            for report_row in report_rows:
+                self.process_input_row(report_row, oauth, sandbox)
+
+        for _ in ordered_map(process_report_rows, reports.values(), self.max_workers):
+            pass
+
+    def process_input_row(self, row, oauth, sandbox):
+        logging.debug(f"Processing row: {row}")
+        company_id = row["PK"]
+        endpoint = row["report"]
+        start_date = row["start_date"]
+        end_date = row["end_date"]
+        summarize_column_by = row["segment_data_by"] or None
+
+        # Clients share the tokens, so they are refreshed only once for all the rows
+        quickbooks_param = self.create_client(company_id, oauth, sandbox)
+
+        # Process endpoints defined in the input table
+        self.process_endpoint(endpoint, quickbooks_param, start_date, end_date, summarize_column_by)
+
+    def get_output_formats(self):
+        """Output format of the tables, the default format can be overridden for tables listed by name."""
+        destination_params = self.configuration.parameters.get(KEY_GROUP_DESTINATION) or {}
+        table_formats = {table_format[KEY_TABLE]: table_format[KEY_OUTPUT_FORMAT]
+                         for table_format in destination_params.get(KEY_TABLE_OUTPUT_FORMATS) or []}
+        try:
+            output_formats = OutputFormats(destination_params.get(KEY_OUTPUT_FORMAT) or "csv", table_formats)
+        except ValueError as e:
+            raise UserException(e) from e
+        logging.debug(f"Output format set to: {output_formats.default}, table output formats: {table_formats}")
+        return output_formats
+
+    def create_client(self, company_id, oauth, sandbox):
+        """Creates QuickBooks client of the company with the run settings, all the clients share the tokens."""
+        try:
+            return QuickbooksClient(company_id=company_id, refresh_token=self.refresh_token,
+                                    access_token=self.access_token, oauth=oauth, sandbox=sandbox,
+                                    max_workers=self.max_workers, token_manager=self.tokens,
+                                    pagination=self.pagination, cache=self.cache)
+        except QuickBooksClientException as e:
+            raise UserException(e) from e
+
+    @staticmethod
+    def open_http_engine():
+        """Opens the async HTTP engine, API requests of all the clients are sent through its connection pool."""
+        try:
+            engine = AsyncEngine()
+        except ImportError as e:
+            raise UserException(e) from e
+        set_http_engine(engine)
+        return engine
+
+    def close_http_engine(self):
+        """Closes connections of the async HTTP engine, the following requests use the requests session."""
+        set_http_engine(requesting)
+        self.http_engine.close()
+        self.http_engine = None
+
+    def open_response_cache(self):
+        """Opens the response cache, the cache saved by the previous run is used if it is among input files."""
+        path = os.path.join(self.files_out_path, RESPONSE_CACHE_FILE)
+        os.makedirs(self.files_out_path, exist_ok=True)
+
+        previous_cache = self.get_input_files_definitions(tags=[RESPONSE_CACHE_TAG])
+        if previous_cache:
+            shutil.copyfile(previous_cache[0].full_path, path)
+            logging.info("Using response cache of the previous run.")
+
+        return ResponseCache(path)
+
+    def save_response_cache(self):
+        """Closes the response cache and outputs it as a file for the next run."""
+        self.cache.close()
+        file_def = self.create_out_file_definition(RESPONSE_CACHE_FILE, tags=[RESPONSE_CACHE_TAG])
+        self.write_manifest(file_def)
+
+    def save_run_metrics(self):
+        """Outputs metrics of the run as a JSON file and logs their summary."""
+        os.makedirs(self.files_out_path, exist_ok=True)
+        run_metrics.write(os.path.join(self.files_out_path, METRICS_FILE))
+        file_def = self.create_out_file_definition(METRICS_FILE, tags=[METRICS_TAG])
+        self.write_manifest(file_def)
+
+    def process_oauth_tokens(self, tokens) -> None:
+        """Called after the tokens are refreshed, saves them using API if they have changed since the last run."""
+        new_refresh_token, new_access_token = tokens.refresh_token, tokens.access_token
         if self.refresh_token != new_refresh_token:
             self.save_new_oauth_tokens(new_refresh_token, new_access_token)
 
@@ -235,10 +397,9 @@ class Component(ComponentBase):
 
         new_state = {
             "component": {
-                "tokens":
-                    {"ts": datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
-                     "#refresh_token": encrypted_refresh_token,
-                     "#access_token": encrypted_access_token}
+                "tokens": self.tokens_state(encrypted_refresh_token, encrypted_access_token),
+                "watermarks": self.watermarks,
+                "checkpoints": self.checkpoints
             }}
         try:
             self.update_config_state(region="CURRENT_STACK",
@@ -251,6 +412,15 @@ class Component(ComponentBase):
                             "is unavailable. Skipping token save at the beginning of the run.")
             return
 
+    def tokens_state(self, refresh_token: str, access_token: str) -> dict:
+        """Tokens part of the statefile, expiration of the access token is kept so it is reused by the next run."""
+        state = {"ts": datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+                 "#refresh_token": refresh_token,
+                 "#access_token": access_token}
+        if self.tokens.expires_at:
+            state["expires_at"] = self.tokens.expires_at.isoformat()
+        return state
+
     @backoff.on_exception(backoff.expo, requests.exceptions.RequestException, max_tries=5)
     def encrypt(self, token: str) -> str:
         url = "https://encryption.keboola.com/encrypt"
@@ -297,31 +467,249 @@ class Component(ComponentBase):
             endpoint = endpoint
             report_api_bool = False
 
-        self.fetch(quickbooks_param=quickbooks_param, endpoint=endpoint, report_api_bool=report_api_bool,
-                   start_date=start_date, end_date=end_date)
+        if not report_api_bool:
+            self.process_entity_endpoint(endpoint, quickbooks_param)
+            return
 
-        logging.debug("Parsing API results...")
-        input_data = quickbooks_param.data
+        if endpoint == "CustomQuery":
+            self.fetch(quickbooks_param=quickbooks_param, endpoint=endpoint, report_api_bool=report_api_bool,
+                       start_date=start_date, end_date=end_date)
+            if quickbooks_param.data:
+                # Not implemented
+                ReportMapping(endpoint=endpoint, data=quickbooks_param.data,
+                              query=start_date, output_formats=self.output_formats)
+            return
 
-        if len(input_data) == 0:
-            pass
-        else:
-            logging.debug(
-                "Report API Template Enable: {0}".format(report_api_bool))
-            if report_api_bool:
-                if endpoint == "CustomQuery":
-                    # Not implemented
-                    ReportMapping(endpoint=endpoint, data=input_data,
-                                  query=start_date)
-                else:
-                    if endpoint in quickbooks_param.reports_required_accounting_type:
-                        input_data_2 = quickbooks_param.data_2
-                        ReportMapping(endpoint=endpoint, data=input_data, accounting_type="accrual")
-                        ReportMapping(endpoint=endpoint, data=input_data_2, accounting_type="cash")
-                    else:
-                        ReportMapping(endpoint=endpoint, data=input_data)
+        if self.report_chunk_size and endpoint in quickbooks_param.reports_chunkable and start_date and end_date:
+            self.process_report_chunks(endpoint, quickbooks_param, start_date, end_date)
+            return
+
+        # Reports are saved to temporary files and parsed incrementally, so their size does not affect memory usage
+        try:
+            self.fetch(quickbooks_param=quickbooks_param, endpoint=endpoint, report_api_bool=report_api_bool,
+                       start_date=start_date, end_date=end_date, stream=True)
+
+            logging.debug("Parsing API results...")
+            if endpoint in quickbooks_param.reports_required_accounting_type:
+                # Accrual and cash variants are written to separate tables, so they are parsed in parallel
+                with ThreadPoolExecutor(max_workers=2) as executor:
+                    parsers = [executor.submit(ReportMapping, endpoint=endpoint, file_path=file_path,
+                                               accounting_type=accounting_type, output_formats=self.output_formats)
+                               for accounting_type, file_path in (("accrual", quickbooks_param.data),
+                                                                  ("cash", quickbooks_param.data_2))]
+                for parser in parsers:
+                    parser.result()
             else:
-                Mapping(endpoint=endpoint, data=input_data)
+                ReportMapping(endpoint=endpoint, file_path=quickbooks_param.data, output_formats=self.output_formats)
+        finally:
+            for file_path in (quickbooks_param.data, quickbooks_param.data_2):
+                if file_path and os.path.isfile(file_path):
+                    os.remove(file_path)
+
+    def process_report_chunks(self, endpoint, quickbooks_param, start_date, end_date):
+        """
+        Fetches the report in date windows in parallel and writes every window into the same output table.
+        If the run fails, the last written window is saved as checkpoint and the next run continues after it.
+        """
+        company_id = quickbooks_param.company_id
+        # Macros such as PrevMonthStart are resolved, so the checkpoint applies only to the same date range
+        try:
+            start_date = parse_date(start_date)
+            end_date = parse_date(end_date)
+        except QuickBooksClientException as e:
+            raise UserException(e) from e
+        checkpoint_key = f"{endpoint}|{start_date.isoformat()}|{end_date.isoformat()}"
+        checkpoint = self.get_checkpoint(company_id, checkpoint_key, chunk_size=self.report_chunk_size)
+
+        completed_until = None
+        fetch_start_date = start_date
+        if checkpoint:
+            completed_until = checkpoint["completed_until"]
+            fetch_start_date = datetime.date.fromisoformat(completed_until) + datetime.timedelta(days=1)
+            logging.info(f"Resuming {endpoint} report from {fetch_start_date}, previous windows are already loaded.")
+            if fetch_start_date > end_date:
+                self.clear_checkpoint(company_id, checkpoint_key)
+                return
+
+        try:
+            chunks = quickbooks_param.report_chunks_request(endpoint, fetch_start_date.isoformat(),
+                                                            end_date.isoformat(), self.report_chunk_size)
+            for window_end, accounting_type, file_path in chunks:
+                try:
+                    ReportMapping(endpoint=endpoint, file_path=file_path, accounting_type=accounting_type,
+                                  write_always=True, output_formats=self.output_formats)
+                finally:
+                    os.remove(file_path)
+
+                # Window is complete once its last accounting method variant is written
+                if accounting_type in ("cash", ""):
+                    completed_until = window_end.isoformat()
+
+        except Exception as e:
+            if completed_until:
+                self.set_checkpoint(company_id, checkpoint_key, {"chunk_size": self.report_chunk_size,
+                                                                 "completed_until": completed_until})
+            if isinstance(e, QuickBooksClientException):
+                raise UserException(e) from e
+            raise
+
+        self.clear_checkpoint(company_id, checkpoint_key)
+
+    def process_entity_endpoint(self, endpoint, quickbooks_param):
+        """
+        Fetches records of the entity endpoint and writes them to the output tables page by page.
+        If the run fails, incrementally loaded tables are loaded anyway and the cursor of the last written page
+        is saved as checkpoint, the next run continues from it.
+        """
+        company_id = quickbooks_param.company_id
+        watermark = self.extraction_start()
+
+        # Only records updated since the last run are fetched for incrementally loaded entity endpoints
+        changed_since = None
+        checkpoint = None
+        if self.incremental_entities:
+            changed_since = self.get_watermark(company_id, endpoint)
+            logging.info(f"Fetching {endpoint} records updated since: {changed_since}")
+            checkpoint = self.get_checkpoint(company_id, endpoint, changed_since=changed_since,
+                                             pagination=self.pagination)
+            # Records updated since the start of the first interrupted part may have been passed already
+            if checkpoint and checkpoint.get("watermark"):
+                watermark = checkpoint["watermark"]
+
+        try:
+            with Mapping(endpoint=endpoint, incremental=self.incremental_entities, tombstones=self.use_cdc,
+                         write_always=self.incremental_entities, output_formats=self.output_formats) as writer:
+                self.fetch(quickbooks_param=quickbooks_param, endpoint=endpoint, report_api_bool=False,
+                           changed_since=changed_since, writer=writer,
+                           resume=checkpoint["cursor"] if checkpoint else None)
+
+        except Exception:
+            if self.incremental_entities and quickbooks_param.cursor:
+                self.set_checkpoint(company_id, endpoint, {
+                    "changed_since": changed_since,
+                    "pagination": self.pagination,
+                    "cursor": quickbooks_param.cursor,
+                    "watermark": watermark
+                })
+            raise
+
+        self.clear_checkpoint(company_id, endpoint)
+        self.set_watermark(company_id, endpoint, watermark)
+
+    @staticmethod
+    def extraction_start():
+        """Watermark of an extraction starting now, the start time minus WATERMARK_LOOKBACK."""
+        return (datetime.datetime.now(datetime.timezone.utc) - WATERMARK_LOOKBACK).isoformat(timespec="seconds")
+
+    def get_checkpoint(self, company_id, key, **settings):
+        """Returns checkpoint of the interrupted extraction if it was made with the same settings."""
+        checkpoint = self.checkpoints.get(company_id, {}).get(key)
+        if checkpoint and all(checkpoint.get(name) == value for name, value in settings.items()):
+            return checkpoint
+        return None
+
+    def set_checkpoint(self, company_id, key, checkpoint):
+        self.checkpoints.setdefault(company_id, {})[key] = checkpoint
+
+    def clear_checkpoint(self, company_id, key):
+        self.checkpoints.get(company_id, {}).pop(key, None)
+
+    def process_cdc_endpoints(self, endpoints, quickbooks_param):
+        """
+        Fetches changes of all entity endpoints with a watermark from the last 30 days in one CDC request.
+        Returns endpoints that have to be processed with regular queries.
+        """
+        company_id = quickbooks_param.company_id
+        cdc_since = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(
+            days=quickbooks_param.cdc_max_days)
+
+        cdc_endpoints = []
+        for endpoint in endpoints:
+            watermark = self.get_watermark(company_id, endpoint)
+            if endpoint in quickbooks_param.cdc_entities and watermark and parse_timestamp(watermark) > cdc_since:
+                cdc_endpoints.append(endpoint)
+
+        if not cdc_endpoints:
+            return endpoints
+
+        # The oldest watermark covers all the endpoints, records fetched repeatedly are upserted by primary key
+        changed_since = min((self.get_watermark(company_id, endpoint) for endpoint in cdc_endpoints),
+                            key=parse_timestamp)
+        logging.info(f"Fetching changes of {cdc_endpoints} since {changed_since} using Change Data Capture.")
+
+        watermark = self.extraction_start()
+        try:
+            changes = quickbooks_param.cdc_request(cdc_endpoints, changed_since)
+        except QuickBooksClientException as e:
+            raise UserException(e) from e
+
+        remaining_endpoints = [endpoint for endpoint in endpoints if endpoint not in cdc_endpoints]
+        for endpoint in cdc_endpoints:
+            data = changes[endpoint]
+            if len(data) >= quickbooks_param.cdc_max_results:
+                logging.info(f"CDC response for {endpoint} is truncated, records will be fetched with queries.")
+                remaining_endpoints.append(endpoint)
+                continue
+
+            logging.info(f"Writing {len(data)} changed rows from {endpoint} endpoint to output file.")
+            if data:
+                with Mapping(endpoint=endpoint, incremental=self.incremental_entities, tombstones=True,
+                             write_always=True, output_formats=self.output_formats) as writer:
+                    writer.write(data)
+            self.set_watermark(company_id, endpoint, watermark)
+
+        return remaining_endpoints
+
+    def process_batch_endpoints(self, endpoints, quickbooks_param):
+        """
+        Fetches small entity endpoints with up to 30 queries per request to the batch endpoint, if batch requests
+        are enabled. Returns endpoints that have to be processed with regular queries, including the batched ones
+        with more records than fit into one page.
+        """
+        if not self.batch_requests:
+            return endpoints
+
+        company_id = quickbooks_param.company_id
+        # Interrupted extractions are resumed by regular queries
+        batch_endpoints = [endpoint for endpoint in endpoints if endpoint in quickbooks_param.batch_entities
+                           and not self.checkpoints.get(company_id, {}).get(endpoint)]
+        if not batch_endpoints:
+            return endpoints
+
+        remaining_endpoints = [endpoint for endpoint in endpoints if endpoint not in batch_endpoints]
+        for i in range(0, len(batch_endpoints), BATCH_MAX_ITEMS):
+            batch = {endpoint: self.get_watermark(company_id, endpoint) if self.incremental_entities else None
+                     for endpoint in batch_endpoints[i:i + BATCH_MAX_ITEMS]}
+            logging.info(f"Fetching {list(batch)} with one batch request.")
+
+            watermark = self.extraction_start()
+            try:
+                results = quickbooks_param.batch_request(batch)
+            except QuickBooksClientException as e:
+                raise UserException(e) from e
+
+            for endpoint, data in results.items():
+                if len(data) >= quickbooks_param.maxresults:
+                    logging.info(f"{endpoint} has more than one page of records, it will be fetched with queries.")
+                    remaining_endpoints.append(endpoint)
+                    continue
+
+                logging.info(f"Writing {len(data)} rows from {endpoint} endpoint to output file.")
+                with Mapping(endpoint=endpoint, incremental=self.incremental_entities, tombstones=self.use_cdc,
+                             write_always=self.incremental_entities, output_formats=self.output_formats) as writer:
+                    writer.write(data)
+                self.set_watermark(company_id, endpoint, watermark)
+
+        return remaining_endpoints
+
+    def get_watermark(self, company_id, endpoint):
+        """Returns MetaData.LastUpdatedTime the records of the endpoint were fetched up to in previous runs."""
+        return self.watermarks.get(company_id, {}).get(endpoint)
+
+    def set_watermark(self, company_id, endpoint, watermark):
+        """Stores the watermark of a finished extraction, it is saved to statefile at the end of the run."""
+        if watermark:
+            self.watermarks.setdefault(company_id, {})[endpoint] = watermark
 
     def get_tokens(self, oauth):
 
@@ -331,6 +719,9 @@ class Component(ComponentBase):
         except TypeError:
             raise UserException("OAuth data is not available.")
 
+        # Expiration of the access token is known only for tokens saved by the component
+        expires_at = None
+
         statefile = self.get_state_file()
         if statefile.get("tokens", {}).get("ts"):
             ts_oauth = datetime.datetime.strptime(oauth["created"], "%Y-%m-%dT%H:%M:%S.%fZ")
@@ -339,13 +730,15 @@ class Component(ComponentBase):
             if ts_statefile > ts_oauth:
                 refresh_token = statefile["tokens"].get("#refresh_token")
                 access_token = statefile["tokens"].get("#access_token")
+                if statefile["tokens"].get("expires_at"):
+                    expires_at = parse_timestamp(statefile["tokens"]["expires_at"])
                 logging.debug("Loaded tokens from statefile.")
             else:
                 logging.debug("Using tokens from oAuth.")
         else:
             logging.warning("No timestamp found in statefile. Using oAuth tokens.")
 
-        return refresh_token, access_token
+        return refresh_token, access_token, expires_at
 
     def process_pnl_report(self, quickbooks_param, start_date, end_date, summarize_column_by):
         results_cash = []
@@ -433,58 +826,70 @@ class Component(ComponentBase):
                     else:
                         raise UserException(f"Cannot Group by {summarize_column_by}")
 
-        for summary_name, summary_id in zip(summary_names, summary_ids):
-            logging.debug(f"Processing summary: {summary_names} with id {summary_ids}")
+        def fetch_summary(summary):
+            summary_name, summary_id = summary
+            logging.debug(f"Processing summary: {summary_name} with id {summary_id}")
 
+            # Every thread gets its own params, the filter differs per summary
+            summary_params = dict(params)
             if summarize_column_by in ["Class", "Department"]:
                 # filter results by Classes or Departments
-                params[str(summarize_column_by).lower()] = summary_id
+                summary_params[str(summarize_column_by).lower()] = summary_id
                 logging.debug(f"Filtering for pnl report is set to: {summarize_column_by}")
             else:
                 logging.debug("Filtering for pnl report is not set.")
 
-            self.fetch(quickbooks_param=quickbooks_param,
-                       endpoint="ProfitAndLoss",
-                       report_api_bool=True,
-                       start_date=start_date,
-                       end_date=end_date,
-                       query="",
-                       params=params)
+            report_accrual, report_cash = quickbooks_param.accounting_reports_request(
+                "ProfitAndLoss", start_date, end_date, summary_params)
+            return summary_name, report_accrual, report_cash
 
-            summarize_by = quickbooks_param.data['Header'].get("SummarizeColumnsBy", False)
+        # Reports of the summaries are fetched by up to max_workers threads,
+        # results are written to the output tables as the reports come in, in the order of the summaries
+        summaries = ordered_map(fetch_summary, zip(summary_names, summary_ids), self.max_workers)
 
-            if not summarize_by:
-                # This part is currently not used since we always group by Class, Department or Total
+        with self.pnl_report_writer("ProfitAndLossQuery_cash") as writer_cash, \
+                self.pnl_report_writer("ProfitAndLossQuery_accrual") as writer_accrual:
+            try:
+                for summary_name, report_accrual_data, report_cash_data in summaries:
+                    results_cash.clear()
+                    results_accrual.clear()
 
-                report_accrual = quickbooks_param.data['Rows']['Row']
-                report_cash = quickbooks_param.data_2['Rows']['Row']
+                    summarize_by = report_accrual_data['Header'].get("SummarizeColumnsBy", False)
 
-                for obj in report_cash:
-                    process_object(obj, summary_name, method="cash")
-                for obj in report_accrual:
-                    process_object(obj, summary_name, method="accrual")
+                    if not summarize_by:
+                        # This part is currently not used since we always group by Class, Department or Total
 
-            else:
-                report_accrual_data = quickbooks_param.data
-                report_cash_data = quickbooks_param.data_2
-
-                header = quickbooks_param.data['Header']
-                summarize_by = header['SummarizeColumnsBy']
-                currency = header['Currency']
-
-                results_cash.append(self.preprocess_dict(report_cash_data,
-                                                         summary_name,
-                                                         summarize_by=summarize_by,
-                                                         currency=currency,
-                                                         start_date=start_date,
-                                                         end_date=end_date))
-
-                results_accrual.append(self.preprocess_dict(report_accrual_data,
-                                                            summary_name,
-                                                            summarize_by=summarize_by,
-                                                            currency=currency,
-                                                            start_date=start_date,
-                                                            end_date=end_date))
+                        report_accrual = report_accrual_data['Rows']['Row']
+                        report_cash = report_cash_data['Rows']['Row']
+
+                        for obj in report_cash:
+                            process_object(obj, summary_name, method="cash")
+                        for obj in report_accrual:
+                            process_object(obj, summary_name, method="accrual")
+
+                    else:
+                        header = report_accrual_data['Header']
+                        summarize_by = header['SummarizeColumnsBy']
+                        currency = header['Currency']
+
+                        results_cash.extend(self.preprocess_dict(report_cash_data,
+                                                                 summary_name,
+                                                                 summarize_by=summarize_by,
+                                                                 currency=currency,
+                                                                 start_date=start_date,
+                                                                 end_date=end_date))
+
+                        results_accrual.extend(self.preprocess_dict(report_accrual_data,
+                                                                    summary_name,
+                                                                    summarize_by=summarize_by,
+                                                                    currency=currency,
+                                                                    start_date=start_date,
+                                                                    end_date=end_date))
+
+                    writer_cash(results_cash)
+                    writer_accrual(results_accrual)
+            except QuickBooksClientException as e:
+                raise UserException(e) from e
 
         """
         # This is here in case we will ever need to do reports that are not summarized
@@ -494,9 +899,6 @@ class Component(ComponentBase):
             suffix = ""
         """
 
-        self.save_pnl_report_to_csv(table_name="ProfitAndLossQuery_cash.csv", results=results_cash)
-        self.save_pnl_report_to_csv(table_name="ProfitAndLossQuery_accrual.csv", results=results_accrual)
-
     @staticmethod
     def preprocess_dict(obj, class_name, summarize_by, currency, start_date, end_date):
         results = []
@@ -558,29 +960,44 @@ class Component(ComponentBase):
 
         return results
 
-    def save_pnl_report_to_csv(self, table_name: str, results: list):
-
-        logging.debug(f"Saving pnl_report results to {table_name}.")
+    @contextmanager
+    def pnl_report_writer(self, table_name: str):
+        """
+        Opens the pnl_report output table and yields function writing rows of one summary to it.
+        The manifest is written once the table is closed. Rows of one summary are written under the lock
+        of the file, so reports processed in parallel do not interleave their rows.
+        """
 
         pk = ["class", "name", "obj_type", "category_id", "start_date", "end_date"]
         columns = ["class", "name", "value", "obj_type", "obj_group", "category_name", "category_id",
                    "start_date", "end_date", "summarize_by", "currency"]
 
-        table_def = self.create_out_table_definition(table_name, primary_key=pk, incremental=self.incremental)
+        output_format = self.output_formats(table_name)
+        file_path = output_path(self.tables_out_path, table_name, output_format)
+        logging.debug(f"Saving pnl_report results to {file_path}.")
+
+        lock = output_lock(file_path)
+        with lock:
+            writer = table_writer(file_path, columns, output_format, header=True, lineterminator='\r\n')
+            writer.flush()
 
-        file_exists = os.path.isfile(table_def.full_path)
+        def write_rows(rows):
+            with lock:
+                writer.writerows([row[column] for column in columns] for row in rows)
+                writer.flush()
 
-        with open(table_def.full_path, 'a', newline='') as csvfile:
-            wr = csv.DictWriter(csvfile, fieldnames=columns)
-            if not file_exists:
-                wr.writeheader()
-            for result in results:
-                wr.writerows(result)
+        with writer:
+            yield write_rows
 
-        self.write_manifest(table_def)
+        # Parquet files are output to File Storage with their own manifest
+        if output_format != "parquet":
+            table_def = self.create_out_table_definition(os.path.basename(file_path), primary_key=pk,
+                                                         incremental=self.incremental)
+            self.write_manifest(table_def)
 
     @staticmethod
-    def fetch(quickbooks_param, endpoint, report_api_bool, start_date=None, end_date=None, query="", params=None):
+    def fetch(quickbooks_param, endpoint, report_api_bool, start_date=None, end_date=None, query="", params=None,
+              changed_since=None, writer=None, stream=False, resume=None):
         logging.debug(f"Fetching endpoint {endpoint} with date rage: {start_date} - {end_date}")
         try:
             quickbooks_param.fetch(
@@ -589,7 +1006,11 @@ class Component(ComponentBase):
                 start_date=start_date,
                 end_date=end_date,
                 query=query if query else "",
-                params=params
+                params=params,
+                changed_since=changed_since,
+                writer=writer,
+                stream=stream,
+                resume=resume
             )
         except QuickBooksClientException as e:
             raise UserException(e) from e
@@ -601,11 +1022,11 @@ class Component(ComponentBase):
             return None
 
         dt_format = '%Y-%m-%d'
-        today = datetime.date.today()
+        prev_month_end = datetime.date.today().replace(day=1) - datetime.timedelta(days=1)
         if dt == "PrevMonthStart":
-            result = today.replace(day=1) - relativedelta(months=1)
+            result = prev_month_end.replace(day=1)
         elif dt == "PrevMonthEnd":
-            result = today.replace(day=1) - relativedelta(days=1)
+            result = prev_month_end
         else:
             try:
                 datetime.date.fromisoformat(dt)
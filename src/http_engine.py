@@ -0,0 +1,192 @@
+import asyncio
+import json
+import logging
+import threading
+
+import requests
+
+# Requests sent to one host at once, QuickBooks allows at most 10 concurrent requests per company
+MAX_REQUESTS_PER_HOST = 10
+# Idle connections are kept open for this many seconds
+KEEPALIVE_EXPIRY = 30
+DEFAULT_TIMEOUT = (10, 300)
+
+
+class EngineResponse:
+    """
+    Response of AsyncEngine with the part of requests.Response interface the client uses
+    Body of stream responses is read from the event loop chunk by chunk, the response has to be closed or read
+    to the end to release its connection.
+    """
+
+    def __init__(self, engine, response, host_limit, stream):
+        self._engine = engine
+        self._response = response
+        self._host_limit = host_limit if stream else None
+        self._stream = stream
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.url = str(response.url)
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def content(self):
+        if self._stream and not self._response.is_closed:
+            try:
+                self._engine.call(self._response.aread())
+            finally:
+                self.close()
+        return self._response.content
+
+    @property
+    def text(self):
+        self.content
+        return self._response.text
+
+    def json(self, **kwargs):
+        return json.loads(self.content, **kwargs)
+
+    def iter_content(self, chunk_size=1):
+        if not self._stream:
+            content = self.content
+            for start in range(0, len(content), chunk_size):
+                yield content[start:start + chunk_size]
+            return
+
+        chunks = self._response.aiter_bytes(chunk_size)
+        try:
+            while True:
+                chunk = self._engine.call(_next_chunk(chunks))
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            self.close()
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise requests.HTTPError(f"{self.status_code} Error for url: {self.url}", response=self)
+
+    def close(self):
+        if self._stream and not self._response.is_closed:
+            self._engine.call(self._response.aclose())
+        if self._host_limit is not None:
+            self._engine.loop.call_soon_threadsafe(self._host_limit.release)
+            self._host_limit = None
+
+
+async def _next_chunk(chunks):
+    try:
+        return await chunks.__anext__()
+    except StopAsyncIteration:
+        return None
+
+
+class AsyncEngine:
+    """
+    HTTP engine sending requests on one asyncio event loop running in a background thread
+    All requests share one httpx connection pool with keep-alive connections and HTTP/2 where the server supports it,
+    requests sent to one host at once are limited by max_requests_per_host.
+    request_async() can be awaited on the loop, request() is the synchronous wrapper with the interface
+    of requests.Session.request, so the engine can replace the session of the client.
+    httpx is imported only when the engine is used.
+    """
+
+    def __init__(self, max_requests_per_host=MAX_REQUESTS_PER_HOST, http2=True, timeout=DEFAULT_TIMEOUT):
+        try:
+            import httpx
+        except ImportError as e:
+            raise ImportError("Async HTTP engine requires httpx to be installed.") from e
+        self.httpx = httpx
+        self.max_requests_per_host = max_requests_per_host
+        self.http2 = http2
+        self.timeout = timeout
+        self.host_limits = {}  # semaphore per host, used only on the loop
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="http-engine", daemon=True)
+        self.thread.start()
+        self.client = self.call(self._open_client())
+
+    async def _open_client(self):
+        http2 = self.http2
+        if http2:
+            try:
+                import h2  # noqa
+            except ImportError:
+                logging.warning("HTTP/2 requires h2 to be installed, HTTP/1.1 is used instead.")
+                http2 = False
+
+        limits = self.httpx.Limits(max_connections=None, max_keepalive_connections=self.max_requests_per_host,
+                                   keepalive_expiry=KEEPALIVE_EXPIRY)
+        return self.httpx.AsyncClient(http2=http2, limits=limits, timeout=self.httpx_timeout(self.timeout))
+
+    def httpx_timeout(self, timeout):
+        """
+        Converts requests timeout, seconds or (connect, read) tuple, to httpx timeout
+        """
+        if isinstance(timeout, tuple):
+            connect, read = timeout
+            return self.httpx.Timeout(read, connect=connect)
+        return self.httpx.Timeout(timeout)
+
+    def call(self, coroutine):
+        """
+        Runs the coroutine on the loop and waits for its result
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def request_async(self, method, url, params=None, headers=None, json=None, data=None, stream=False,
+                            timeout=None):
+        """
+        Sends the request, the body of stream responses is not read
+        Returns httpx response and the semaphore of its host, which is held until stream response is closed.
+        """
+        # Unlike requests, httpx replaces the query of the URL by params, so they are merged into the URL
+        url = self.httpx.URL(url)
+        if params:
+            url = url.copy_merge_params(params)
+        request = self.client.build_request(method, url, headers=headers, json=json, data=data,
+                                            timeout=self.httpx_timeout(timeout or self.timeout))
+
+        host_limit = self.host_limits.get(request.url.host)
+        if host_limit is None:
+            host_limit = self.host_limits[request.url.host] = asyncio.Semaphore(self.max_requests_per_host)
+
+        await host_limit.acquire()
+        try:
+            response = await self.client.send(request, stream=stream)
+        except BaseException:
+            host_limit.release()
+            raise
+        if not stream:
+            host_limit.release()
+        return response, host_limit
+
+    def request(self, method, url, stream=False, **kwargs):
+        """
+        Sends the request from the calling thread
+        httpx errors are raised as requests exceptions, so they are retried the same way.
+        """
+        try:
+            response, host_limit = self.call(self.request_async(method, url, stream=stream, **kwargs))
+        except self.httpx.TimeoutException as e:
+            raise requests.Timeout(str(e)) from e
+        except self.httpx.TransportError as e:
+            raise requests.ConnectionError(str(e)) from e
+        return EngineResponse(self, response, host_limit, stream)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def close(self):
+        """
+        Closes the connections and stops the loop
+        """
+        self.call(self.client.aclose())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
@@ -1,218 +1,329 @@
-import uuid
-import pandas as pd
+import datetime
+import hashlib
 import json
 import logging
 import sys  # noqa
 import os
+import time
+from decimal import Decimal
+from functools import lru_cache
+from typing import Any, Callable, Dict, NamedTuple, Optional, Tuple
+
+from metrics import run_metrics
+from table_writer import OutputFormats, output_path, table_writer
 
 
 # destination to fetch and output files
 cwd_parent = os.path.dirname(os.getcwd())
 DEFAULT_FILE_INPUT = os.path.join(cwd_parent, "data/in/tables/")
 DEFAULT_FILE_DESTINATION = os.path.join(cwd_parent, "data/out/tables/")
+MAPPINGS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mappings.json")
 
 
-class Mapping:
+def to_bool(value):
+    if isinstance(value, bool):
+        return value
+    if str(value).lower() in ("true", "false"):
+        return str(value).lower() == "true"
+    raise ValueError(f"Invalid boolean: {value}")
+
+
+def to_int(value):
+    number = Decimal(str(value))
+    if number != number.to_integral_value():
+        raise ValueError(f"Invalid integer: {value}")
+    return int(number)
+
+
+def to_date(value):
+    return datetime.date.fromisoformat(value[:10])
+
+
+def to_datetime(value):
+    return datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+class DataType(NamedTuple):
     """
-    Handling Generic Ex Mapping
+    Declared type of the column
+    convert     - converts the source value, raises ValueError if it does not match the type
+    basetype    - Keboola base type written to the column metadata of the output manifest
     """
+    convert: Callable[[Any], Any]
+    basetype: str
 
-    def __init__(self, endpoint, data):
 
-        self.endpoint = endpoint
-        self.mapping = self.mapping_check(self.endpoint)
-        self.out_file = {self.endpoint: []}
-        self.out_file_pk = {self.endpoint: []}  # destination name from mapping
-        self.out_file_pk_raw = {}  # raw destination name from API output
-        self.get_primary_key(endpoint, self.mapping)
+# Types declared by dataType of the column mapping in mappings.json, other columns are output as they are
+DATA_TYPES = {
+    "decimal": DataType(lambda value: Decimal(str(value)), "NUMERIC"),
+    "int": DataType(to_int, "INTEGER"),
+    "bool": DataType(to_bool, "BOOLEAN"),
+    "date": DataType(to_date, "DATE"),
+    "datetime": DataType(to_datetime, "TIMESTAMP")
+}
 
-        # Runs
-        self.root_parse(data)
-        self.output()
 
-    @staticmethod
-    def mapping_check(endpoint):
+class ColumnPlan(NamedTuple):
+    """
+    Compiled column of the mapping
+    path    - keys leading to the value in the source record, e.g. ("MetaData", "LastUpdatedTime")
+    header  - output column name
+    table   - plan of the nested table, None for plain columns
+    convert - converter of the declared type, None for columns without type
+    """
+    path: Tuple[str, ...]
+    header: str
+    table: Optional["TablePlan"] = None
+    convert: Optional[Callable[[Any], Any]] = None
+
+
+class TablePlan(NamedTuple):
+    """
+    Compiled mapping of one output table
+    nested tables end with the parent_table column referencing their parent row and the row_key column
+    identifying the row, both are part of their primary key
+    data_types - declared type of the typed columns by their header
+    """
+    name: str
+    columns: Tuple[ColumnPlan, ...]
+    header: Tuple[str, ...]
+    primary_key: Tuple[str, ...]
+    key_paths: Tuple[Tuple[str, ...], ...]
+    nested: bool
+    data_types: Dict[str, str]
+
+    def tables(self):
         """
-        Selecting the Right Mapping for the specified endpoint
+        Yields the plan and plans of all its nested tables
         """
-        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "mappings.json"), 'r') as f:
-            out = json.load(f)
-        f.close()
-        return out[endpoint]
+        yield self
+        for column in self.columns:
+            if column.table is not None:
+                yield from column.table.tables()
+
+
+@lru_cache(maxsize=None)
+def load_mappings():
+    """
+    Loading mappings.json, the file is read only once per process
+    """
+    with open(MAPPINGS_PATH, 'r') as f:
+        return json.load(f)
+
+
+@lru_cache(maxsize=None)
+def compile_mapping(endpoint):
+    """
+    Compiling the mapping of the endpoint into a plan of the output tables
+    """
+    return _compile_table(endpoint, load_mappings()[endpoint], nested=False)
+
+
+def _compile_table(table_name, mapping, nested):
+    columns = []
+    primary_key = []
+    key_paths = []
+    data_types = {}
+
+    for column in mapping:
+        if mapping[column]["type"] == "column":
+            header = mapping[column]["mapping"]["destination"]
+            data_type = mapping[column]["mapping"].get("dataType")
+            if data_type is not None and data_type not in DATA_TYPES:
+                raise ValueError(f"Unknown dataType {data_type} of {table_name} column {column}")
+
+            convert = None
+            if data_type is not None:
+                convert = DATA_TYPES[data_type].convert
+                data_types[header] = data_type
+            columns.append(ColumnPlan(path=tuple(column.split(".")), header=header, convert=convert))
 
-    def root_parse(self, data):
+            # Confirm if the primary key tab is true
+            if mapping[column]["mapping"].get("primaryKey"):
+                primary_key.append(header)
+                key_paths.append(tuple(column.split(".")))
+
+        elif mapping[column]["type"] == "table":
+            sub_table = _compile_table(mapping[column]["destination"], mapping[column]["tableMapping"], nested=True)
+
+            # Primary key of the sub table is returned to the root table under the mapping name
+            columns.append(ColumnPlan(path=tuple(column.split(".")), header=column, table=sub_table))
+
+    header = [column.header for column in columns]
+    if nested:
+        # Keys of the nested rows repeat across parent records (Invoice-Line ID), or the rows have no key at all
+        header.extend(["parent_table", "row_key"])
+        primary_key.extend(["parent_table", "row_key"])
+
+    return TablePlan(name=table_name, columns=tuple(columns), header=tuple(header),
+                     primary_key=tuple(primary_key), key_paths=tuple(key_paths), nested=nested, data_types=data_types)
+
+
+class Mapping:
+    """
+    Handling Generic Ex Mapping
+    Rows are written to the output tables as they are parsed, every output file is opened only once.
+    Call close() after the last write() to close the files and produce the manifests.
+    """
+
+    def __init__(self, endpoint, incremental=False, tombstones=False, write_always=False, output_formats=None):
+
+        self.endpoint = endpoint
+        self.incremental = bool(incremental)
+        self.write_always = write_always  # tables are loaded even if the job fails, so resumed runs can continue
+        self.tombstones = tombstones  # Deleted column marking records deleted in QuickBooks (CDC extraction)
+        self.output_formats = output_formats or OutputFormats()  # output format of every table
+        self.plan = compile_mapping(self.endpoint)
+        self.out_writer = {}  # open table writer per table
+        self.out_file_header = {plan.name: list(plan.header) for plan in self.plan.tables()}
+        self.out_file_pk = {plan.name: list(plan.primary_key) for plan in self.plan.tables()}
+        self.out_file_types = {plan.name: dict(plan.data_types) for plan in self.plan.tables()}
+
+        if self.tombstones:
+            self.out_file_header[self.endpoint].append("Deleted")
+            self.out_file_types[self.endpoint]["Deleted"] = "bool"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, data):
         """
-        Parsing the Root property of the return data
+        Parsing the Root property of the return data and writing the rows to the output tables
         """
 
-        # data = self.data
-        mapping = self.mapping
-
+        started = time.monotonic()
         for row in data:
             # Looping row by row
-            self.parsing(self.endpoint, mapping, row)
+            self.parsing(self.plan, row, row_id=self.root_row_id(row))
+        run_metrics.record_parsing(self.endpoint, len(data), time.monotonic() - started)
 
-    def parsing(self, table_name, mapping, data):
+    def root_row_id(self, data):
         """
-        Outputting data results based on configured mapping
+        Identity of the root record, made of its primary key values
+        Records of tables without primary key are identified by their content.
         """
 
-        # If new table property is found,
-        # create a new array to store values
-        if table_name not in self.out_file:
-            self.out_file[table_name] = []
-
-        row_out = {}  # Storing row output
+        if not self.plan.key_paths:
+            return self.endpoint + "|" + json.dumps(data, sort_keys=True)
+
+        values = [self.endpoint]
+        for path in self.plan.key_paths:
+            value = data
+            try:
+                for word in path:
+                    value = value[word]
+            except Exception:
+                value = ""
+            values.append(str(value))
+        return "|".join(values)
+
+    def parsing(self, plan, data, parent_key=None, row_id=""):
+        """
+        Outputting data results based on the compiled mapping plan
+        row_id  - identity of the record the keys of its nested tables are derived from
+        """
 
-        # Looping through the keys of the mapping
-        for column in mapping:
-            if mapping[column]["type"] == "column":
-                # Delimit mapping variables
-                if "." in column:
-                    temp_value = column.split(".")
+        row_out = []  # Storing row output in the order of the table header
 
-                    try:
-                        # Looping through the array
-                        # value = data[temp_value[0]][temp_value[1]]
-                        value = data
-                        for word in temp_value:
-                            value = value[word]
-                    except Exception:
-                        value = ""
-                else:
-                    try:
-                        value = data[column]
-                    except Exception:
-                        value = ""
-                header = mapping[column]["mapping"]["destination"]
-
-            elif mapping[column]["type"] == "table":
-
-                # Setting up table parameters,
-                # mappings and values for parsing the nested table
-                mapping_name = column
-                # Mapping for the table
-                mapping_in = mapping[column]["tableMapping"]
-                # New table output name
-                sub_table_name = mapping[column]["destination"]
-                sub_table_exist = True  # Determine if the table column exist as a property in source file
-                sub_table_row_exist = True  # Determine if there are any rows within the sub table
-
-                # Passing the function if the JSON property is not found
+        for column in plan.columns:
+            if column.table is None:
                 try:
-                    if "." in mapping_name:
-                        temp_value = mapping_name.split(".")
-                        data_in = data
-                        for word in temp_value:
-                            data_in = data_in[word]
-                    else:
-                        data_in = data[mapping_name]
-
-                    if len(data_in) == 0:
-                        sub_table_row_exist = False
-                except KeyError:
-                    sub_table_exist = False
-
-                # Verify if the sub-table exist in the root table
-                if sub_table_exist and sub_table_row_exist:
-
-                    # Setting up nested table primary key
-                    # Using current table id to create unique pk with md5
-                    string_of_pk = ""  # Concat all the PK as a string # noqa
-                    # Iterate through all the pk
-                    sub_table_pk = mapping[column]["destination"] + \
-                        "-"+str(uuid.uuid4().hex)
-
-                    mapping_in["parent_table"] = {
-                        "type": "pk",
-                        "value": sub_table_pk
-                    }
-
-                    # Loop nested table
-                    self._parse_table(sub_table_name, mapping_in, data_in)
-
-                    # Returning sub table PK
-                    value = sub_table_pk
-
-                else:
+                    # Looping through the path
+                    value = data
+                    for word in column.path:
+                        value = value[word]
+                except Exception:
                     value = ""
 
-                # Primary key return to the root table
-                header = column
+                # Value is converted to the declared type, values not matching the type are output as they are
+                if column.convert is not None and value != "" and value is not None:
+                    try:
+                        value = column.convert(value)
+                    except (ValueError, TypeError, ArithmeticError):
+                        pass
+
+            else:
+                value = self._parse_table(column, data, row_id)
 
-            # Sub table's Primary Key
-            # Source: injected new property when new table is found in the mapping
-            elif mapping[column]["type"] == "pk":
+            row_out.append(value)
 
-                header = column
-                value = mapping[column]["value"]
+        # Sub table's Primary Key and the key of the row derived from its position in the parent record
+        if plan.nested:
+            row_out.append(parent_key)
+            row_out.append(plan.name + "-" + hashlib.md5(row_id.encode("utf-8")).hexdigest())
 
-            # Injecting new table elements for the row
-            row_out[header] = value
+        # Tombstone flag of the root table, deleted records contain only Id and MetaData
+        if self.tombstones and not plan.nested:
+            row_out.append(data.get("status") == "Deleted")
 
         # Storing JSON tables
-        out_file = self.out_file
-        out_file[table_name].append(row_out)
-        self.out_file = out_file
+        self.write_row(plan.name, row_out)
 
-    def _parse_table(self, table_name, mapping, data):
+    def write_row(self, table_name, row):
         """
-        Parsing table data
-        Determining the type of the sub-table
-        *** Sub-function of parse() ***
+        Writing one row into the output table
+        If new table is found, its output file is opened
         """
 
-        if isinstance(data, dict):
-            self.parsing(table_name, mapping, data)
+        if table_name not in self.out_writer:
+            output_format = self.output_formats(table_name)
+            file_dest = output_path(DEFAULT_FILE_DESTINATION, table_name, output_format)
+            logging.debug("Table output: {0}...".format(file_dest))
+            self.out_writer[table_name] = table_writer(file_dest, self.out_file_header[table_name], output_format,
+                                                       types=self.out_file_types[table_name])
 
-        elif isinstance(data, list):
-            for row in data:
-                self.parsing(table_name, mapping, row)
+        self.out_writer[table_name].writerow(row)
 
-    def get_primary_key(self, table_name, mapping):
+    def _parse_table(self, column, data, row_id):
         """
-        Filtering out all the primary keys within the mapping table
+        Parsing nested table data
+        Determining the type of the sub-table
+        Returns primary key of the sub table rows, empty string if the sub table has no rows
+        *** Sub-function of parsing() ***
         """
 
-        # If table_name does not exist in the PK list
-        if table_name not in self.out_file_pk_raw:
-
-            self.out_file_pk_raw[table_name] = []
-            self.out_file_pk[table_name] = []
-
-        for column in mapping:
-
-            # Column type is "column"
-            if mapping[column]["type"] == "column":
+        # Passing the function if the JSON property is not found
+        try:
+            data_in = data
+            for word in column.path:
+                data_in = data_in[word]
+        except KeyError:
+            return ""
 
-                # Search if the primaryKey property is within the mapping configuration
-                if "primaryKey" in mapping[column]["mapping"]:
+        # Verify if there are any rows within the sub table
+        if not data_in:
+            return ""
 
-                    # Confirm if the primary key tab is true
-                    if mapping[column]["mapping"]["primaryKey"]:
+        # Setting up nested table primary key
+        # Derived from the parent record and the nested path with md5, so repeated extractions produce the same key
+        sub_table_row_id = row_id + "/" + ".".join(column.path)
+        sub_table_pk = column.table.name + "-" + hashlib.md5(sub_table_row_id.encode("utf-8")).hexdigest()
 
-                        self.out_file_pk_raw[table_name].append(column)
-                        self.out_file_pk[table_name].append(
-                            mapping[column]["mapping"]["destination"])
+        if isinstance(data_in, dict):
+            self.parsing(column.table, data_in, sub_table_pk, sub_table_row_id + "/0")
 
-            # Column type is "table"
-            if mapping[column]["type"] == "table":
+        elif isinstance(data_in, list):
+            for index, row in enumerate(data_in):
+                self.parsing(column.table, row, sub_table_pk, sub_table_row_id + "/" + str(index))
 
-                # Recursively run the tableMapping
-                self.get_primary_key(
-                    table_name=mapping[column]["destination"], mapping=mapping[column]["tableMapping"])
+        return sub_table_pk
 
     @staticmethod
-    def produce_manifest(file_name, primary_key, columns):
+    def produce_manifest(file_name, primary_key, columns, incremental=False, write_always=False, output_format="csv",
+                         data_types=None):
         """
         Dummy function to return header per file type.
+        data_types - declared type of the typed columns, written to the column metadata as Keboola base types
         """
 
-        file = DEFAULT_FILE_DESTINATION+str(file_name)+".csv.manifest"
+        file = output_path(DEFAULT_FILE_DESTINATION, str(file_name), output_format) + ".manifest"
         logging.debug("Manifest output: {0}".format(file))
 
         manifest_template = {
-            "incremental": False,
+            "incremental": incremental,
             "delimiter": ",",
             "enclosure": "\""
         }
@@ -222,6 +333,13 @@ class Mapping:
         manifest = manifest_template
         manifest["primary_key"] = primary_key
         manifest["columns"] = columns
+        if data_types:
+            manifest["column_metadata"] = {
+                column: [{"key": "KBC.datatype.basetype", "value": DATA_TYPES[data_type].basetype}]
+                for column, data_type in data_types.items()
+            }
+        if write_always:
+            manifest["write_always"] = True
 
         try:
             with open(file, 'w') as file_out:
@@ -234,21 +352,21 @@ class Mapping:
 
         return
 
-    def output(self):
+    def close(self):
         """
-        Output Data with its desired file name
+        Closing the output files and producing their manifests
         """
 
-        # Outputting files
-        out_file = self.out_file
+        for table_name, writer in self.out_writer.items():
+            writer.close()
 
-        for file in out_file:
-
-            out_df = pd.DataFrame(out_file[file])
-            file_dest = DEFAULT_FILE_DESTINATION+file+".csv"
-            out_df.to_csv(file_dest, index=False, mode='a', header=False)
-            logging.debug("Table output: {0}...".format(file_dest))
+            # Parquet files are output to File Storage with their own manifest
+            output_format = self.output_formats(table_name)
+            if output_format == "parquet":
+                continue
 
             # Outputting manifest file if incremental
-            out_file_pk = self.out_file_pk  # noqa
-            self.produce_manifest(file, self.out_file_pk[file], out_df.columns.values.tolist())
+            self.produce_manifest(table_name, self.out_file_pk[table_name], self.out_file_header[table_name],
+                                  self.incremental, self.write_always, output_format, self.out_file_types[table_name])
+
+        self.out_writer = {}
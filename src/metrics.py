@@ -0,0 +1,171 @@
+import json
+import logging
+import threading
+import time
+import urllib.parse as url_parse
+
+from response_cache import QUERY_ENTITY
+
+# Upper bounds of the request latency histogram buckets in seconds, the last bucket counts slower requests
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def endpoint_label(url):
+    """
+    Endpoint of the API request the metrics are recorded under, e.g. query/Invoice, reports/GeneralLedger or batch
+    """
+    parsed = url_parse.urlparse(url)
+    path = parsed.path.rstrip("/")
+    name = path.rsplit("/", 1)[-1]
+
+    if name == "query":
+        query = url_parse.parse_qs(parsed.query).get("query", [""])[0]
+        match = QUERY_ENTITY.search(query)
+        return "query/" + match.group(1) if match else "query"
+    if "/reports/" in path:
+        return "reports/" + name
+    return name
+
+
+class RunMetrics:
+    """
+    Thread-safe metrics of one run
+    Requests are recorded per endpoint with their latency histogram, bytes received and retries,
+    parsing per endpoint or report with the number of records and time spent, output per table with its rows and size.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.monotonic()
+            self.requests = {}
+            self.refreshes = 0
+            self.parsing = {}
+            self.tables = {}
+
+    def _endpoint(self, url):
+        endpoint = endpoint_label(url)
+        if endpoint not in self.requests:
+            self.requests[endpoint] = {
+                "requests": 0,
+                "retries": 0,
+                "errors": 0,
+                "bytes_received": 0,
+                "latency_sum": 0.0,
+                "latency_max": 0.0,
+                "latency_histogram": [0] * (len(LATENCY_BUCKETS) + 1),
+                "status_codes": {}
+            }
+        return self.requests[endpoint]
+
+    def record_request(self, url, seconds, status_code=None):
+        """
+        Records one attempt of the request, status_code is None if the request failed without response
+        """
+        bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound), len(LATENCY_BUCKETS))
+        with self._lock:
+            endpoint = self._endpoint(url)
+            endpoint["requests"] += 1
+            endpoint["latency_sum"] += seconds
+            endpoint["latency_max"] = max(endpoint["latency_max"], seconds)
+            endpoint["latency_histogram"][bucket] += 1
+            status = str(status_code) if status_code is not None else "error"
+            endpoint["status_codes"][status] = endpoint["status_codes"].get(status, 0) + 1
+            if status_code is None or status_code >= 400:
+                endpoint["errors"] += 1
+
+    def record_retry(self, url):
+        with self._lock:
+            self._endpoint(url)["retries"] += 1
+
+    def record_bytes(self, url, size):
+        with self._lock:
+            self._endpoint(url)["bytes_received"] += size
+
+    def record_refresh(self):
+        with self._lock:
+            self.refreshes += 1
+
+    def record_parsing(self, name, records, seconds):
+        """
+        Records records of the endpoint or report parsed and written in the given time
+        """
+        with self._lock:
+            parsing = self.parsing.setdefault(name, {"records": 0, "seconds": 0.0})
+            parsing["records"] += records
+            parsing["seconds"] += seconds
+
+    def record_table(self, file_name, rows, size):
+        """
+        Records rows written to the output table and its size once the table is closed
+        Tables written repeatedly keep the size of their last write, which includes the previous ones.
+        """
+        with self._lock:
+            table = self.tables.setdefault(file_name, {"rows": 0, "bytes_written": 0})
+            table["rows"] += rows
+            table["bytes_written"] = size
+
+    def summary(self):
+        """
+        Metrics of the run as a JSON serializable dict
+        """
+        with self._lock:
+            elapsed = time.monotonic() - self.started
+            requests = {}
+            for name, endpoint in self.requests.items():
+                requests[name] = dict(endpoint, latency_histogram=dict(zip(
+                    [f"le_{bound}" for bound in LATENCY_BUCKETS] + ["inf"], endpoint["latency_histogram"])))
+                requests[name]["status_codes"] = dict(endpoint["status_codes"])
+                requests[name]["latency_avg"] = endpoint["latency_sum"] / endpoint["requests"] \
+                    if endpoint["requests"] else 0.0
+
+            parsing = {}
+            for name, item in self.parsing.items():
+                parsing[name] = dict(item, records_per_second=item["records"] / item["seconds"]
+                                     if item["seconds"] else None)
+
+            return {
+                "elapsed_seconds": elapsed,
+                "totals": {
+                    "requests": sum(endpoint["requests"] for endpoint in self.requests.values()),
+                    "retries": sum(endpoint["retries"] for endpoint in self.requests.values()),
+                    "errors": sum(endpoint["errors"] for endpoint in self.requests.values()),
+                    "token_refreshes": self.refreshes,
+                    "bytes_received": sum(endpoint["bytes_received"] for endpoint in self.requests.values()),
+                    "records_parsed": sum(item["records"] for item in self.parsing.values()),
+                    "parsing_seconds": sum(item["seconds"] for item in self.parsing.values()),
+                    "rows_written": sum(table["rows"] for table in self.tables.values()),
+                    "bytes_written": sum(table["bytes_written"] for table in self.tables.values())
+                },
+                "requests": requests,
+                "parsing": parsing,
+                "tables": {name: dict(table) for name, table in self.tables.items()}
+            }
+
+    def summary_line(self, summary=None):
+        """
+        One line summary of the run for the job log
+        """
+        totals = (summary or self.summary())["totals"]
+        records_per_second = totals["records_parsed"] / totals["parsing_seconds"] if totals["parsing_seconds"] else 0
+        return (f"Run metrics: {totals['requests']} requests ({totals['retries']} retries, {totals['errors']} errors, "
+                f"{totals['token_refreshes']} token refreshes), {totals['bytes_received'] / 1024 / 1024:.1f} MB "
+                f"received, {totals['records_parsed']} records parsed at {records_per_second:.0f} records/s, "
+                f"{totals['rows_written']} rows and {totals['bytes_written'] / 1024 / 1024:.1f} MB written "
+                f"in {(summary or self.summary())['elapsed_seconds']:.1f} s.")
+
+    def write(self, path):
+        """
+        Writes the metrics to the JSON file and logs their summary
+        """
+        summary = self.summary()
+        with open(path, 'w') as f:
+            json.dump(summary, f, indent=2)
+        logging.info(self.summary_line(summary))
+
+
+# Metrics of the current run, shared by all clients and writers
+run_metrics = RunMetrics()
@@ -1,9 +1,13 @@
 import os
 import logging
-import csv
 import json
-import pandas as pd
-import copy
+import tempfile
+import threading
+import time
+import ijson
+
+from metrics import run_metrics
+from table_writer import OutputFormats, output_path, table_writer
 
 "__author__ = 'Leo Chan'"
 "__credits__ = 'Keboola 2017'"
@@ -17,6 +21,40 @@ Python 3 environment
 cwd_parent = os.path.dirname(os.getcwd())
 DEFAULT_FILE_INPUT = os.path.join(cwd_parent, "data/in/tables/")
 DEFAULT_FILE_DESTINATION = os.path.join(cwd_parent, "data/out/tables/")
+CHUNK_SIZE = 1024 * 1024
+
+_output_locks = {}
+_output_locks_lock = threading.Lock()
+
+
+def report_items(file_path, prefix):
+    """
+    Yields objects found under the prefix of the report JSON file, e.g. Rows.Row.item,
+    without loading the whole file into memory
+    """
+    with open(file_path, 'rb') as f:
+        yield from ijson.items(f, prefix, use_float=True)
+
+
+def output_lock(file_path):
+    """
+    Lock of the output file
+    Reports processed in parallel hold it while writing, so their rows never interleave in the file.
+    """
+    with _output_locks_lock:
+        if file_path not in _output_locks:
+            _output_locks[file_path] = threading.Lock()
+        return _output_locks[file_path]
+
+
+def csv_field(value):
+    """
+    Quoting a value the same way csv.writer does
+    """
+    value = "" if value is None else str(value)
+    if any(char in value for char in ',"\r\n'):
+        return '"' + value.replace('"', '""') + '"'
+    return value
 
 
 class ReportMapping:
@@ -24,11 +62,22 @@ class ReportMapping:
     Parser dedicated for Report endpoint
     """
 
-    def __init__(self, endpoint, data, query='', accounting_type=''):
+    def __init__(self, endpoint, data=None, query='', accounting_type='', file_path=None, write_always=False,
+                 output_formats=None):
+        """
+        data        - decoded report
+        file_path   - report saved in a JSON file, it is read incrementally instead of data
+        write_always - the table is loaded even if the job fails, so resumed runs can continue
+        output_formats - output format of every table, CSV by default
+        """
         # Parameters
         self.endpoint = endpoint
         self.data = data
-        self.header = self.construct_header(data)
+        self.file_path = file_path
+        if file_path:
+            self.header = self.construct_header({"Header": next(report_items(file_path, "Header"), None)})
+        else:
+            self.header = self.construct_header(data)
         self.columns = [
             # "Time",
             "ReportName",
@@ -39,6 +88,8 @@ class ReportMapping:
         self.primary_key = ["ReportName", "StartPeriod", "EndPeriod"]
         self.query = query
         self.accounting_type = accounting_type
+        self.write_always = write_always
+        self.output_formats = output_formats or OutputFormats()
         # Output
         self.data_out = []
 
@@ -54,9 +105,11 @@ class ReportMapping:
         if endpoint not in report_cant_parse:
 
             self.itr = 1
-            self.data_out = self.parse(
-                data["Rows"]["Row"], self.header, self.itr)
-            self.columns = self.arrange_header(self.columns)
+            if file_path:
+                rows = report_items(file_path, "Rows.Row.item")
+            else:
+                rows = data["Rows"]["Row"]
+            self.data_out = self.parse(rows, self.header, self.itr)
             self.output(self.endpoint, self.data_out, self.primary_key)
 
         elif endpoint == "CustomQuery":
@@ -73,10 +126,14 @@ class ReportMapping:
             for item in self.columns:
                 self.data_out.append(self.header[item])
 
-            self.data_out.append("{0}".format(json.dumps(data)))
             self.columns.append("value")
-            self.output_1cell(self.endpoint, self.columns,
-                              self.data_out, self.primary_key)
+            if file_path:
+                self.output_1cell_file(self.endpoint, self.columns,
+                                       self.data_out, file_path, self.primary_key)
+            else:
+                self.data_out.append("{0}".format(json.dumps(data)))
+                self.output_1cell(self.endpoint, self.columns,
+                                  self.data_out, self.primary_key)
 
     @staticmethod
     def construct_header(data):
@@ -85,7 +142,7 @@ class ReportMapping:
         *** Endpoint Report specific ***
         """
 
-        if "Header" not in data:
+        if not data.get("Header"):
 
             raise Exception("Header is missing. Unable to parse request.")
 
@@ -118,85 +175,73 @@ class ReportMapping:
 
         return columns
 
-    def parse(self, data_in, row, itr):  # , data_out):
+    def add_column(self, column, primary_key=True):
+        """
+        Registering column found while parsing
+        """
+
+        if column not in self.columns:
+            self.columns.append(column)
+            if primary_key:
+                self.primary_key.append(column)
+
+    def parse(self, data_in, row, itr):
         """
-        Main parser for rows
+        Main parser for rows, yields flat output rows
         Params:
         data_in     - input data for parser
-        row         - output json formatted row for one sub section within the table
+        row         - header values shared by all rows of the section, it is never modified
         itr         - record of the number of recursion
         """
 
-        data_out = []
         for i in data_in:
-            temp_row = copy.deepcopy(row)
             row_name = "Col_{0}".format(itr)
 
             if ("type" not in i) and ("group" in i):
 
-                if row_name not in self.columns:
-                    self.columns.append(row_name)
-                    self.primary_key.append(row_name)
+                self.add_column(row_name)
 
-                temp_out = []
-                row[row_name] = i["group"]
-                row["Col_{0}".format(itr + 1)] = i["ColData"][0]["value"]
-                row["value"] = i["ColData"][1]["value"]
-                temp_out = [row]
-                data_out = data_out + temp_out
+                yield {**row,
+                       row_name: i["group"],
+                       "Col_{0}".format(itr + 1): i["ColData"][0]["value"],
+                       "value": i["ColData"][1]["value"]}
 
             elif i["type"] == "Section":
 
-                if row_name not in self.columns:
-                    self.columns.append(row_name)
-                    self.primary_key.append(row_name)
+                self.add_column(row_name)
 
                 # Use Group if Header is not found as column values
                 if "Header" in i:
 
-                    row[row_name] = i["Header"]["ColData"][0]["value"]
                     # Recursion when type data is not found
-                    temp_out = self.parse(i["Rows"]["Row"], row, itr + 1)
+                    yield from self.parse(i["Rows"]["Row"], {**row, row_name: i["Header"]["ColData"][0]["value"]},
+                                          itr + 1)
 
                 elif "group" in i:
 
-                    # Column name
-                    row[row_name] = i["group"]
+                    self.add_column("Col_{0}".format(itr + 1))
 
                     # Row value , assuming no more recursion
-                    row["Col_{0}".format(
-                        itr + 1)] = i["Summary"]["ColData"][0]["value"]
-                    row["value"] = i["Summary"]["ColData"][1]["value"]
-                    temp_out = [row]
-
-                    if "Col_{0}".format(itr + 1) not in self.columns:
-                        self.columns.append("Col_{0}".format(itr + 1))
-                        self.primary_key.append("Col_{0}".format(itr + 1))
-
-                data_out = data_out + temp_out  # Append data back to section
+                    yield {**row,
+                           row_name: i["group"],
+                           "Col_{0}".format(itr + 1): i["Summary"]["ColData"][0]["value"],
+                           "value": i["Summary"]["ColData"][1]["value"]}
 
             elif (i["type"] == "Data") or ("ColData" in i):
 
-                if row_name not in self.columns:
-                    self.columns.append(row_name)
-                    self.primary_key.append(row_name)
-                temp_row[row_name] = i["ColData"][0]["value"]
-
-                row_value = "value"
-                if row_value not in self.columns:
-                    self.columns.append(row_value)
-                temp_row[row_value] = i["ColData"][1]["value"]
+                self.add_column(row_name)
+                self.add_column("value", primary_key=False)
 
-                data_out.append(temp_row)
+                yield {**row,
+                       row_name: i["ColData"][0]["value"],
+                       "value": i["ColData"][1]["value"]}
 
             else:
                 raise Exception(
                     "No type found within the row. Please validate the data.")
 
-        return data_out
-
     @staticmethod
-    def produce_manifest(file_name, primary_key):
+    def produce_manifest(file_name, primary_key, write_always=False):
         """
         Dummy function to return header per file type.
         """
@@ -218,6 +263,8 @@ class ReportMapping:
 
         manifest = manifest_template
         manifest["primary_key"] = primary_key
+        if write_always:
+            manifest["write_always"] = True
 
         try:
             with open(file, 'w') as file_out:
@@ -231,20 +278,58 @@ class ReportMapping:
     def output(self, endpoint, data, pk):
         """
         Outputting JSON
+        Columns are discovered while parsing, so the rows are spooled to a temporary file
+        and written out once the header is complete
         """
 
-        temp_df = pd.DataFrame(data)
-        if self.accounting_type == '':
-            filename = endpoint + ".csv"
-        else:
-            filename = "{0}_{1}.csv".format(endpoint, self.accounting_type)
+        table_name = self.table_name(endpoint)
+        output_format = self.output_formats(table_name)
+        file_out_path = output_path(DEFAULT_FILE_DESTINATION, table_name, output_format)
+        filename = os.path.basename(file_out_path)
 
         logging.info("Outputting {0}...".format(filename))
-        file_out_path = DEFAULT_FILE_DESTINATION + filename
         print(f"Saving file to: {file_out_path}")
-        temp_df.to_csv(file_out_path,
-                       index=False, columns=self.columns)
-        self.produce_manifest(filename, pk)
+        started = time.monotonic()
+        records = 0
+        with tempfile.TemporaryFile('w+') as spool:
+            for row in data:
+                spool.write(json.dumps(row) + "\n")
+                records += 1
+
+            self.columns = self.arrange_header(self.columns)
+            spool.seek(0)
+            with output_lock(file_out_path), table_writer(file_out_path, self.columns, output_format, mode='w',
+                                                          header=True) as writer:
+                for line in spool:
+                    row = json.loads(line)
+                    writer.writerow([row.get(column, "") for column in self.columns])
+        run_metrics.record_parsing(table_name, records, time.monotonic() - started)
+
+        # Parquet files are output to File Storage with their own manifest
+        if output_format != "parquet":
+            self.produce_manifest(filename, pk, self.write_always)
+
+    def table_name(self, endpoint):
+        """
+        Name of the output table, accrual and cash variants of the report are output to separate tables
+        """
+
+        if self.accounting_type == '':
+            return endpoint
+        return "{0}_{1}".format(endpoint, self.accounting_type)
+
+    def output_1cell_path(self, endpoint):
+        """
+        Path of the table with the whole report in one cell
+        Parquet is not used for these tables, they are output as compressed CSV instead.
+        """
+
+        table_name = self.table_name(endpoint)
+        output_format = self.output_formats(table_name)
+        if output_format == "parquet":
+            logging.warning(f"{table_name} report cannot be output as Parquet, it is output as compressed CSV.")
+            output_format = "csv_gzip"
+        return output_path(DEFAULT_FILE_DESTINATION, table_name, output_format), output_format
 
     def output_1cell(self, endpoint, columns, data, pk):
         """
@@ -252,25 +337,37 @@ class ReportMapping:
         """
 
         # Construct output filename
-        if self.accounting_type == '':
-            filename = endpoint + ".csv"
-        else:
-            filename = "{0}_{1}.csv".format(endpoint, self.accounting_type)
-
-        # if file exist, not outputing column header
-        if os.path.isfile(DEFAULT_FILE_DESTINATION + filename):
-            data_out = [data]
-        else:
-            data_out = [columns, data]
-
-        with open(DEFAULT_FILE_DESTINATION + filename, "a") as f:
-            writer = csv.writer(f)
-            # writer.writerow(["range", "start_date", "end_date", "content"])
-            # writer.writerow([date_concat, start_date, end_date, "{0}".format(self.content)])
-            writer.writerows(data_out)
-            # f.write(["content"])
-            # f.write(["{0}"].format(self.content))
-        f.close()
+        file_out_path, output_format = self.output_1cell_path(endpoint)
+        filename = os.path.basename(file_out_path)
+
+        with output_lock(file_out_path):
+            # if file exist, not outputing column header
+            with table_writer(file_out_path, columns, output_format, header=True, lineterminator='\r\n') as writer:
+                # writer.writerow(["range", "start_date", "end_date", "content"])
+                # writer.writerow([date_concat, start_date, end_date, "{0}".format(self.content)])
+                writer.writerow(data)
         logging.info("Outputting {0}... ".format(filename))
         # if not os.path.isfile(DEFAULT_FILE_DESTINATION+filename):
-        self.produce_manifest(filename, pk)
+        self.produce_manifest(filename, pk, self.write_always)
+
+    def output_1cell_file(self, endpoint, columns, data, file_path, pk):
+        """
+        Output everything into one cell
+        The report JSON file is copied into the last cell chunk by chunk
+        """
+
+        # Construct output filename
+        file_out_path, output_format = self.output_1cell_path(endpoint)
+        filename = os.path.basename(file_out_path)
+
+        with output_lock(file_out_path):
+            # if file exist, not outputing column header
+            with table_writer(file_out_path, columns, output_format, header=True, lineterminator='\r\n') as f, \
+                    open(file_path, "r", encoding="utf-8") as f_in:
+                f.write(",".join(csv_field(value) for value in data) + ',"')
+                for chunk in iter(lambda: f_in.read(CHUNK_SIZE), ""):
+                    f.write(chunk.replace('"', '""'))
+                f.write('"\r\n', rows=1)
+
+        logging.info("Outputting {0}... ".format(filename))
+        self.produce_manifest(filename, pk, self.write_always)
@@ -0,0 +1,138 @@
+import datetime
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+import urllib.parse as url_parse
+import zlib
+from typing import NamedTuple, Optional
+
+# Reference entities change rarely, their records are cached for a day
+REFERENCE_ENTITIES = ("Term", "TaxCode", "TaxRate", "Class", "Department")
+REFERENCE_TTL = 24 * 60 * 60
+# Reports of periods ended before the current month are closed, they are cached for a month
+CLOSED_PERIOD_TTL = 30 * 24 * 60 * 60
+# Larger responses are not cached
+MAX_BODY_SIZE = 64 * 1024 * 1024
+
+QUERY_ENTITY = re.compile(r"\bfrom\s+(\w+)", re.IGNORECASE)
+
+
+class CachedResponse(NamedTuple):
+    """
+    Response found in the cache
+    fresh - the response can be used without revalidation
+    """
+    body: bytes
+    etag: Optional[str]
+    last_modified: Optional[str]
+    fresh: bool
+
+
+def cache_ttl(url):
+    """
+    Seconds the response of the request is cached for, None if it is not cached
+    Reports of closed periods are cached. Query responses are not, records of reference entities are cached
+    as one listing instead, see listing_ttl().
+    """
+    parsed = url_parse.urlparse(url)
+    query = url_parse.parse_qs(parsed.query)
+
+    if "/reports/" in parsed.path:
+        end_date = query.get("end_date", [""])[0]
+        try:
+            period_end = datetime.date.fromisoformat(end_date)
+        except ValueError:
+            return None
+        if period_end < datetime.date.today().replace(day=1):
+            return CLOSED_PERIOD_TTL
+
+    return None
+
+
+def listing_ttl(endpoint):
+    """
+    Seconds all the records of the entity endpoint are cached for, None if they are not cached
+    The count and the pages of the listing are not cached separately, so they always come from the same snapshot.
+    """
+    if endpoint in REFERENCE_ENTITIES:
+        return REFERENCE_TTL
+    return None
+
+
+class ResponseCache:
+    """
+    API responses stored in a SQLite database
+    Responses are keyed by the company, URL and params of the request and stored compressed. Fresh responses are
+    served without a request, expired responses with ETag or Last-Modified are revalidated with a conditional request.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS responses ("
+                                 "key TEXT PRIMARY KEY, body BLOB, etag TEXT, last_modified TEXT, expires_at REAL)")
+        # Expired responses without validators cannot be used anymore
+        self._connection.execute("DELETE FROM responses "
+                                 "WHERE expires_at < ? AND etag IS NULL AND last_modified IS NULL", (time.time(),))
+        self._connection.commit()
+
+    @staticmethod
+    def key(company_id, url, params=None):
+        request = json.dumps([company_id, url, sorted((params or {}).items())], default=str)
+        return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """
+        Returns the cached response, None if there is no usable response
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT body, etag, last_modified, expires_at FROM responses WHERE key = ?",
+                                           (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        body, etag, last_modified, expires_at = row
+        fresh = expires_at >= time.time()
+        if not fresh and not (etag or last_modified):
+            self.misses += 1
+            return None
+
+        if fresh:
+            self.hits += 1
+        return CachedResponse(zlib.decompress(body), etag, last_modified, fresh)
+
+    def put(self, key, body, ttl, etag=None, last_modified=None):
+        """
+        Stores the response body for ttl seconds
+        """
+        if len(body) > MAX_BODY_SIZE:
+            logging.debug(f"Response of {len(body)} bytes is too large to be cached.")
+            return
+
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                                     (key, zlib.compress(body), etag, last_modified, time.time() + ttl))
+            self._connection.commit()
+
+    def touch(self, key, ttl):
+        """
+        Extends the cached response by ttl seconds after it was revalidated
+        """
+        self.hits += 1
+        with self._lock:
+            self._connection.execute("UPDATE responses SET expires_at = ? WHERE key = ?", (time.time() + ttl, key))
+            self._connection.commit()
+
+    def close(self):
+        logging.info(f"Response cache: {self.hits} requests served from the cache, {self.misses} not cached.")
+        with self._lock:
+            self._connection.execute("VACUUM")
+            self._connection.close()
@@ -0,0 +1,276 @@
+import csv
+import datetime
+import decimal
+import gzip
+import json
+import logging
+import os
+
+from metrics import run_metrics
+
+# csv      - plain CSV table
+# csv_gzip - gzip compressed CSV table
+# parquet  - Parquet file output to File Storage, Storage tables cannot be loaded from Parquet
+OUTPUT_FORMATS = ("csv", "csv_gzip", "parquet")
+PARQUET_ROW_GROUP_SIZE = 100000
+PARQUET_TAG = "quickbooks_parquet"
+# Scale of Parquet decimal columns, decimal values are rounded to it
+PARQUET_DECIMAL_SCALE = 10
+# Python types of the values matching the declared type, other values are written to Parquet as nulls
+PARQUET_VALUE_TYPES = {
+    "decimal": (decimal.Decimal,),
+    "int": (int,),
+    "bool": (bool,),
+    "date": (datetime.date,),
+    "datetime": (datetime.datetime,)
+}
+
+
+class OutputFormats:
+    """
+    Output format of every table, tables not listed in tables use the default format
+    Names of the tables the format was looked up for are kept, so misspelled table names can be reported.
+    """
+
+    def __init__(self, default="csv", tables=None):
+        self.default = default
+        self.tables = tables or {}
+        self.used_tables = set()
+
+        for output_format in [default, *self.tables.values()]:
+            if output_format not in OUTPUT_FORMATS:
+                raise ValueError(f"Unknown output format: {output_format}. "
+                                 f"Valid values are: {', '.join(OUTPUT_FORMATS)}")
+
+    def __call__(self, table_name):
+        self.used_tables.add(table_name)
+        return self.tables.get(table_name, self.default)
+
+    def unused_tables(self):
+        """Listed tables no output table was named like"""
+        return sorted(set(self.tables) - self.used_tables)
+
+
+def output_path(destination, file_name, output_format="csv"):
+    """
+    Path of the output table file
+    destination - folder of the output tables, Parquet files are output to the files folder next to it
+    file_name   - name of the table file without extension, e.g. Invoice or BalanceSheet_cash
+    """
+    if output_format == "parquet":
+        files_destination = os.path.join(os.path.dirname(os.path.normpath(destination)), "files")
+        return os.path.join(files_destination, file_name + ".parquet")
+    if output_format == "csv_gzip":
+        return os.path.join(destination, file_name + ".csv.gz")
+    return os.path.join(destination, file_name + ".csv")
+
+
+def table_writer(path, columns, output_format="csv", mode="a", header=False, lineterminator="\n", types=None):
+    """
+    Opens writer of the output table
+    mode    - 'a' appends rows to the existing table, 'w' replaces it
+    header  - the columns are written as the first row of new CSV tables
+    types   - declared type of the typed columns, e.g. {"Balance": "decimal"}, see mapping.DATA_TYPES
+    """
+    if output_format == "parquet":
+        return ParquetWriter(path, columns, mode, types)
+    return CsvWriter(path, columns, mode, header, lineterminator, compressed=output_format == "csv_gzip",
+                     types=types)
+
+
+def produce_file_manifest(path, tags):
+    """
+    Manifest of the file output to File Storage
+    """
+    manifest = {
+        "tags": tags,
+        "is_permanent": False
+    }
+    with open(path + ".manifest", 'w') as file_out:
+        json.dump(manifest, file_out)
+
+
+class CsvWriter:
+    """
+    Writer of plain or gzip compressed CSV table
+    Rows appended to the compressed table are written as a new gzip member.
+    Values of datetime columns are written in ISO 8601 format, values of decimal columns in fixed-point notation
+    (str() writes 1E-7 or 0E-8), other values as they are formatted by csv.writer.
+    Rows written and size of the file are recorded in run_metrics when the writer is closed.
+    """
+
+    def __init__(self, path, columns, mode="a", header=False, lineterminator="\n", compressed=False, types=None):
+        self.path = path
+        self.rows_written = 0
+        file_exists = mode == "a" and os.path.isfile(path)
+        types = types or {}
+        self.datetime_columns = [index for index, column in enumerate(columns) if types.get(column) == "datetime"]
+        self.decimal_columns = [index for index, column in enumerate(columns) if types.get(column) == "decimal"]
+
+        if compressed:
+            self.file = gzip.open(path, mode + "t", newline="", encoding="utf-8")
+        else:
+            self.file = open(path, mode, newline="")
+        self.writer = csv.writer(self.file, lineterminator=lineterminator)
+
+        if header and not file_exists:
+            self.writer.writerow(columns)
+
+    def writerow(self, row):
+        for index in self.datetime_columns:
+            if hasattr(row[index], "isoformat"):
+                row[index] = row[index].isoformat()
+        for index in self.decimal_columns:
+            if isinstance(row[index], decimal.Decimal):
+                row[index] = format(row[index], "f")
+        self.writer.writerow(row)
+        self.rows_written += 1
+
+    def writerows(self, rows):
+        if self.datetime_columns or self.decimal_columns:
+            for row in rows:
+                self.writerow(row)
+        else:
+            rows = list(rows)
+            self.writer.writerows(rows)
+            self.rows_written += len(rows)
+
+    def write(self, text, rows=0):
+        """
+        Writes already formatted CSV text
+        rows - number of rows the text completes
+        """
+        self.file.write(text)
+        self.rows_written += rows
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+        run_metrics.record_table(os.path.basename(self.path), self.rows_written, os.path.getsize(self.path))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ParquetWriter:
+    """
+    Writer of Parquet file, rows are written in row groups of PARQUET_ROW_GROUP_SIZE rows as they come
+    Rows appended to an existing file are written to a new file with numbered suffix, Parquet files cannot be appended.
+    Typed columns get the Parquet type of their declared type, values of other Python types are written as nulls.
+    pyarrow is imported only when Parquet output is used.
+    """
+
+    def __init__(self, path, columns, mode="a", types=None):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError as e:
+            raise ImportError("Parquet output requires pyarrow to be installed.") from e
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if mode == "a":
+            path = self.free_path(path)
+        self.path = path
+
+        self.columns = list(columns)
+        types = types or {}
+        parquet_types = {
+            "decimal": pyarrow.decimal128(38, PARQUET_DECIMAL_SCALE),
+            "int": pyarrow.int64(),
+            "bool": pyarrow.bool_(),
+            "date": pyarrow.date32(),
+            "datetime": pyarrow.timestamp("us", tz="UTC")
+        }
+        self.schema = pyarrow.schema([(column, parquet_types.get(types.get(column), pyarrow.string()))
+                                      for column in self.columns])
+        self.value_types = [PARQUET_VALUE_TYPES.get(types.get(column)) for column in self.columns]
+        self.decimal_exponent = decimal.Decimal(1).scaleb(-PARQUET_DECIMAL_SCALE)
+        self.invalid_columns = set()
+        self.rows = []
+        self.rows_written = 0
+        self.writer = self.pq.ParquetWriter(self.path, self.schema, compression="snappy")
+
+    @staticmethod
+    def free_path(path):
+        base = path[:-len(".parquet")]
+        part = 1
+        while os.path.isfile(path):
+            path = "{0}_{1}.parquet".format(base, part)
+            part += 1
+        return path
+
+    def writerow(self, row):
+        self.rows.append(row)
+        self.rows_written += 1
+        if len(self.rows) >= PARQUET_ROW_GROUP_SIZE:
+            self.write_row_group()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def flush(self):
+        """
+        Buffered rows are written once there are enough of them for a row group, or when the file is closed
+        """
+
+    def write_row_group(self):
+        """
+        Writes the buffered rows as one row group
+        """
+        if not self.rows:
+            return
+
+        arrays = []
+        for index, field in enumerate(self.schema):
+            values = [self.value(row[index] if index < len(row) else None, field, self.value_types[index])
+                      for row in self.rows]
+            arrays.append(self.pa.array(values, type=field.type))
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+        self.rows = []
+
+    def value(self, value, field, value_types=None):
+        """
+        Value of the field, values of typed fields not matching the type are output as nulls
+        value_types - Python types of the values matching the declared type, None for string fields
+        """
+        if value is None or value == "":
+            return None
+        if value_types is None:
+            return value if isinstance(value, str) else str(value)
+
+        # Values which could not be converted to the declared type are left as they came, e.g. 1 in a bool column
+        # or a dict in a decimal column. Exact types are compared, since bool is int and datetime is date.
+        if type(value) in value_types:
+            if not isinstance(value, decimal.Decimal):
+                return value
+            try:
+                return value.quantize(self.decimal_exponent, context=decimal.Context(prec=38))
+            except decimal.InvalidOperation:
+                pass
+
+        if field.name not in self.invalid_columns:
+            self.invalid_columns.add(field.name)
+            logging.warning(f"Column {field.name} of {os.path.basename(self.path)} contains values "
+                            f"not matching its type {field.type}, they are output as nulls.")
+        return None
+
+    def close(self):
+        self.write_row_group()
+        self.writer.close()
+        logging.debug(f"Parquet file output: {self.path}")
+        run_metrics.record_table(os.path.basename(self.path), self.rows_written, os.path.getsize(self.path))
+        produce_file_manifest(self.path, [PARQUET_TAG, os.path.basename(self.path)])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,58 @@
+import unittest
+from datetime import date
+
+from client import QuickBooksClientException, split_date_range
+
+
+class TestSplitDateRange(unittest.TestCase):
+
+    def test_months_across_year_boundary(self):
+        self.assertEqual(split_date_range(date(2023, 11, 15), date(2024, 2, 10), "month"), [
+            (date(2023, 11, 15), date(2023, 11, 30)),
+            (date(2023, 12, 1), date(2023, 12, 31)),
+            (date(2024, 1, 1), date(2024, 1, 31)),
+            (date(2024, 2, 1), date(2024, 2, 10))
+        ])
+
+    def test_month_ends(self):
+        windows = split_date_range(date(2024, 1, 31), date(2024, 3, 31), "month")
+        self.assertEqual(windows, [
+            (date(2024, 1, 31), date(2024, 1, 31)),
+            (date(2024, 2, 1), date(2024, 2, 29)),
+            (date(2024, 3, 1), date(2024, 3, 31))
+        ])
+
+    def test_weeks_across_year_boundary(self):
+        # 2024-12-30 is Monday, the week ends on Sunday 2025-01-05
+        self.assertEqual(split_date_range(date(2024, 12, 25), date(2025, 1, 8), "week"), [
+            (date(2024, 12, 25), date(2024, 12, 29)),
+            (date(2024, 12, 30), date(2025, 1, 5)),
+            (date(2025, 1, 6), date(2025, 1, 8))
+        ])
+
+    def test_days(self):
+        self.assertEqual(split_date_range(date(2023, 12, 31), date(2024, 1, 1), "day"), [
+            (date(2023, 12, 31), date(2023, 12, 31)),
+            (date(2024, 1, 1), date(2024, 1, 1))
+        ])
+
+    def test_single_day_range(self):
+        for chunk_size in ("day", "week", "month"):
+            self.assertEqual(split_date_range(date(2024, 2, 29), date(2024, 2, 29), chunk_size),
+                             [(date(2024, 2, 29), date(2024, 2, 29))])
+
+    def test_windows_cover_range_without_gaps(self):
+        start, end = date(2019, 12, 28), date(2021, 1, 3)
+        for chunk_size in ("day", "week", "month"):
+            windows = split_date_range(start, end, chunk_size)
+            self.assertEqual(windows[0][0], start)
+            self.assertEqual(windows[-1][1], end)
+            for (_, previous_end), (next_start, _) in zip(windows, windows[1:]):
+                self.assertEqual((next_start - previous_end).days, 1)
+
+    def test_empty_range(self):
+        self.assertEqual(split_date_range(date(2024, 2, 1), date(2024, 1, 31), "month"), [])
+
+    def test_unknown_chunk_size(self):
+        with self.assertRaises(QuickBooksClientException):
+            split_date_range(date(2024, 1, 1), date(2024, 1, 31), "year")
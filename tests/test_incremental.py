@@ -0,0 +1,152 @@
+import datetime
+import re
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from client import QuickbooksClient, QuickBooksClientException, TokenManager
+from component import Component
+from keboola.component.exceptions import UserException
+
+WATERMARK = "2024-01-01T00:00:00+00:00"
+
+
+class FakeQueries:
+    """Answers the entity queries of the client from a list of records with Ids 1..records"""
+
+    def __init__(self, entity="Invoice", records=2500, fail_at=None):
+        self.entity = entity
+        self.records = [{"Id": str(i)} for i in range(1, records + 1)]
+        self.fail_at = fail_at
+        self.queries = []
+
+    def __call__(self, query):
+        self.queries.append(query)
+        if self.fail_at is not None and len(self.queries) == self.fail_at:
+            raise QuickBooksClientException("Request failed")
+        limit = int(re.search(r"MAXRESULTS (\d+)", query).group(1))
+        after_id = re.search(r"Id > '(\d+)'", query)
+        start = int(after_id.group(1)) if after_id else 0
+        startposition = re.search(r"STARTPOSITION (\d+)", query)
+        if startposition:
+            start = int(startposition.group(1)) - 1
+        return self.records[start:start + limit]
+
+
+def create_client(pagination="keyset", queries=None):
+    expires_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
+    tokens = TokenManager("access", "refresh", "key", "secret", expires_at=expires_at)
+    quickbooks = QuickbooksClient("123", "access", "refresh", SimpleNamespace(appKey="key", appSecret="secret"),
+                                  False, token_manager=tokens, pagination=pagination)
+    quickbooks.query_request = queries or FakeQueries()
+    quickbooks.get_count = lambda: len(quickbooks.query_request.records)
+    return quickbooks
+
+
+class TestEntityWhereClause(unittest.TestCase):
+
+    def test_no_conditions(self):
+        self.assertEqual(QuickbooksClient.entity_where_clause("Invoice"), "")
+
+    def test_changed_since(self):
+        self.assertEqual(QuickbooksClient.entity_where_clause("Invoice", WATERMARK),
+                         f" WHERE MetaData.LastUpdatedTime >= '{WATERMARK}'")
+
+    def test_changed_since_with_keyset_cursor(self):
+        self.assertEqual(QuickbooksClient.entity_where_clause("Invoice", WATERMARK, after_id="1000"),
+                         f" WHERE MetaData.LastUpdatedTime >= '{WATERMARK}' AND Id > '1000'")
+
+    def test_class_with_all_conditions(self):
+        self.assertEqual(QuickbooksClient.entity_where_clause("Class", WATERMARK, after_id="0"),
+                         f" WHERE Active IN (true, false) AND MetaData.LastUpdatedTime >= '{WATERMARK}' AND Id > '0'")
+
+    def test_keyset_pages_keep_watermark(self):
+        quickbooks = create_client()
+        quickbooks.fetch("Invoice", False, None, None, changed_since=WATERMARK)
+        self.assertEqual(len(quickbooks.data), 2500)
+        self.assertEqual(quickbooks.query_request.queries, [
+            f"SELECT * FROM Invoice WHERE MetaData.LastUpdatedTime >= '{WATERMARK}' ORDERBY Id MAXRESULTS 1000",
+            f"SELECT * FROM Invoice WHERE MetaData.LastUpdatedTime >= '{WATERMARK}' AND Id > '1000' "
+            f"ORDERBY Id MAXRESULTS 1000",
+            f"SELECT * FROM Invoice WHERE MetaData.LastUpdatedTime >= '{WATERMARK}' AND Id > '2000' "
+            f"ORDERBY Id MAXRESULTS 1000"
+        ])
+
+
+class TestClientResume(unittest.TestCase):
+
+    def test_keyset_resumes_after_cursor(self):
+        quickbooks = create_client("keyset")
+        quickbooks.fetch("Invoice", False, None, None, resume={"last_id": "2000"})
+        self.assertEqual([record["Id"] for record in quickbooks.data[:1]], ["2001"])
+        self.assertEqual(len(quickbooks.data), 500)
+        self.assertEqual(quickbooks.cursor, {"last_id": "2500"})
+
+    def test_offset_resumes_at_startposition(self):
+        quickbooks = create_client("offset")
+        quickbooks.fetch("Invoice", False, None, None, resume={"startposition": 1001})
+        self.assertEqual(len(quickbooks.data), 1500)
+        self.assertEqual(quickbooks.data[0]["Id"], "1001")
+
+    def test_cursor_of_last_written_page_is_kept_on_failure(self):
+        quickbooks = create_client("keyset", FakeQueries(fail_at=3))
+        with self.assertRaises(QuickBooksClientException):
+            quickbooks.fetch("Invoice", False, None, None)
+        self.assertEqual(quickbooks.cursor, {"last_id": "2000"})
+
+
+class TestCheckpointResume(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch("component.Mapping")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.component = Component.__new__(Component)
+        self.component.incremental_entities = True
+        self.component.use_cdc = False
+        self.component.pagination = "keyset"
+        self.component.output_formats = None
+        self.component.watermarks = {"123": {"Invoice": WATERMARK}}
+        self.component.checkpoints = {}
+
+    def run_extraction(self, queries, started):
+        quickbooks = create_client("keyset", queries)
+        with mock.patch.object(Component, "extraction_start", return_value=started):
+            self.component.process_entity_endpoint("Invoice", quickbooks)
+
+    def test_interrupted_extraction_is_resumed(self):
+        first = FakeQueries(fail_at=3)
+        with self.assertRaises(UserException):
+            self.run_extraction(first, "2024-02-01T00:00:00+00:00")
+        self.assertEqual(self.component.checkpoints["123"]["Invoice"], {
+            "changed_since": WATERMARK,
+            "pagination": "keyset",
+            "cursor": {"last_id": "2000"},
+            "watermark": "2024-02-01T00:00:00+00:00"
+        })
+        # Watermark is not moved until the extraction is complete
+        self.assertEqual(self.component.watermarks["123"]["Invoice"], WATERMARK)
+
+        second = FakeQueries()
+        self.run_extraction(second, "2024-02-02T00:00:00+00:00")
+        self.assertEqual(second.queries, [f"SELECT * FROM Invoice WHERE MetaData.LastUpdatedTime >= '{WATERMARK}' "
+                                          f"AND Id > '2000' ORDERBY Id MAXRESULTS 1000"])
+        self.assertEqual(self.component.checkpoints["123"], {})
+        # Records updated since the start of the first attempt may have been passed, so its start is kept
+        self.assertEqual(self.component.watermarks["123"]["Invoice"], "2024-02-01T00:00:00+00:00")
+
+    def test_checkpoint_of_other_settings_is_ignored(self):
+        self.component.checkpoints = {"123": {"Invoice": {"changed_since": WATERMARK, "pagination": "offset",
+                                                          "cursor": {"startposition": 2001},
+                                                          "watermark": "2024-02-01T00:00:00+00:00"}}}
+        queries = FakeQueries()
+        self.run_extraction(queries, "2024-02-02T00:00:00+00:00")
+        self.assertEqual(len(queries.queries), 3)
+        self.assertNotIn("Id > ", queries.queries[0])
+        self.assertEqual(self.component.watermarks["123"]["Invoice"], "2024-02-02T00:00:00+00:00")
+
+    def test_watermark_is_extraction_start_minus_lookback(self):
+        started = datetime.datetime.now(datetime.timezone.utc)
+        watermark = datetime.datetime.fromisoformat(Component.extraction_start())
+        self.assertAlmostEqual((started - watermark).total_seconds(), 300, delta=2)
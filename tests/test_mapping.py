@@ -0,0 +1,62 @@
+import csv
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from mapping import Mapping
+
+
+def invoice(invoice_id, line_ids):
+    return {"Id": invoice_id, "Line": [{"Id": line_id, "Amount": 10} for line_id in line_ids]}
+
+
+class TestNestedTableKeys(unittest.TestCase):
+
+    def setUp(self):
+        self.destination = tempfile.mkdtemp() + os.sep
+        patcher = mock.patch("mapping.DEFAULT_FILE_DESTINATION", self.destination)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.destination)
+
+    def parse(self, records):
+        """Parses the records to a new Invoice-Line table, returns its rows as dicts and the manifest"""
+        path = os.path.join(self.destination, "Invoice-Line.csv")
+        if os.path.exists(path):
+            os.remove(path)
+        with Mapping("Invoice", incremental=True) as writer:
+            writer.write(records)
+            columns = writer.out_file_header["Invoice-Line"]
+        with open(path, newline="") as f:
+            rows = [dict(zip(columns, row)) for row in csv.reader(f)]
+        with open(path + ".manifest") as f:
+            manifest = json.load(f)
+        return rows, manifest
+
+    @staticmethod
+    def keys(rows):
+        return [(row["parent_table"], row["row_key"]) for row in rows]
+
+    def test_primary_key_contains_parent_table_and_row_key(self):
+        _, manifest = self.parse([invoice("1", ["1"])])
+        self.assertEqual(manifest["primary_key"][-2:], ["parent_table", "row_key"])
+        self.assertEqual(manifest["columns"][-2:], ["parent_table", "row_key"])
+        self.assertTrue(manifest["incremental"])
+
+    def test_same_record_produces_same_keys(self):
+        first, _ = self.parse([invoice("1", ["1", "2"])])
+        second, _ = self.parse([invoice("1", ["1", "2"])])
+        self.assertEqual(self.keys(first), self.keys(second))
+        self.assertTrue(all(parent and key for parent, key in self.keys(first)))
+
+    def test_same_line_id_of_different_parents_gets_distinct_keys(self):
+        rows, _ = self.parse([invoice("1", ["1", "2"]), invoice("2", ["1", "2"])])
+        self.assertEqual([row["ID"] for row in rows], ["1", "2", "1", "2"])
+        keys = self.keys(rows)
+        self.assertEqual(len(set(keys)), 4)
+        # Lines of one invoice share the parent reference
+        self.assertEqual(keys[0][0], keys[1][0])
+        self.assertNotEqual(keys[0][0], keys[2][0])
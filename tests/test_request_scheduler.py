@@ -0,0 +1,217 @@
+import datetime
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import format_datetime
+from unittest import mock
+
+import requests
+
+from client import QuickBooksClientException, RequestScheduler, TokenBucket
+
+
+class FakeResponse:
+
+    def __init__(self, status_code=200, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.text = ""
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class ConcurrentRequests:
+    """Fake session recording the highest number of requests in flight at once"""
+
+    def __init__(self, duration=0.01):
+        self.duration = duration
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def request(self, method, url, **kwargs):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.duration)
+        with self.lock:
+            self.in_flight -= 1
+        return FakeResponse()
+
+
+def create_scheduler(**kwargs):
+    return RequestScheduler(requests_per_minute=600000, burst=1000, **kwargs)
+
+
+class TestConcurrencyLimit(unittest.TestCase):
+
+    def test_requests_in_flight_are_limited(self):
+        session = ConcurrentRequests()
+        scheduler = create_scheduler(max_concurrent=3)
+        with mock.patch("client.requesting", session):
+            # Nested thread pools of the callers share the limit of the company
+            with ThreadPoolExecutor(max_workers=4) as outer:
+                def nested(_):
+                    with ThreadPoolExecutor(max_workers=4) as inner:
+                        list(inner.map(lambda _: scheduler.get("https://quickbooks/query"), range(4)))
+                list(outer.map(nested, range(4)))
+        self.assertEqual(session.max_in_flight, 3)
+
+    def test_stream_response_holds_slot_until_closed(self):
+        scheduler = create_scheduler(max_concurrent=1)
+        with mock.patch("client.requesting", ConcurrentRequests(0)):
+            response = scheduler.get("https://quickbooks/reports/BalanceSheet", stream=True)
+
+            second = threading.Thread(target=scheduler.get, args=("https://quickbooks/query",))
+            second.start()
+            second.join(0.2)
+            self.assertTrue(second.is_alive())
+
+            response.close()
+            second.join(1)
+            self.assertFalse(second.is_alive())
+
+    def test_slot_is_released_while_waiting_for_retry(self):
+        responses = [FakeResponse(503, {"Retry-After": "0"}), FakeResponse(200)]
+        session = mock.Mock()
+        session.request.side_effect = responses
+        scheduler = create_scheduler(max_concurrent=1)
+        with mock.patch("client.requesting", session):
+            self.assertIs(scheduler.get("https://quickbooks/query"), responses[1])
+        self.assertTrue(responses[0].closed)
+        # The slot is free again
+        self.assertTrue(scheduler.slots.acquire(blocking=False))
+
+
+class Clock:
+    """Fake monotonic clock, sleeping advances it"""
+
+    def __init__(self):
+        self.now = 100.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        for name in ("monotonic", "sleep"):
+            patcher = mock.patch(f"client.time.{name}", getattr(self.clock, name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_burst_of_capacity_requests(self):
+        bucket = TokenBucket(rate=2, capacity=3)
+        for _ in range(3):
+            bucket.acquire()
+        self.assertEqual(self.clock.sleeps, [])
+
+        # Fourth request waits for one token at 2 tokens per second
+        bucket.acquire()
+        self.assertEqual(self.clock.sleeps, [0.5])
+
+    def test_refill_is_capped_by_capacity(self):
+        bucket = TokenBucket(rate=2, capacity=3)
+        for _ in range(3):
+            bucket.acquire()
+        self.clock.now += 60
+        for _ in range(3):
+            bucket.acquire()
+        self.assertEqual(self.clock.sleeps, [])
+        bucket.acquire()
+        self.assertEqual(self.clock.sleeps, [0.5])
+
+    def test_partial_refill(self):
+        bucket = TokenBucket(rate=2, capacity=3)
+        for _ in range(3):
+            bucket.acquire()
+        self.clock.now += 0.25
+        bucket.acquire()
+        self.assertEqual(self.clock.sleeps, [0.25])
+
+    def test_pause_empties_bucket(self):
+        bucket = TokenBucket(rate=2, capacity=3)
+        bucket.pause(5)
+        bucket.acquire()
+        self.assertAlmostEqual(sum(self.clock.sleeps), 5.0)
+
+
+class TestRetryAfter(unittest.TestCase):
+
+    @staticmethod
+    def retry_after(value):
+        return RequestScheduler.retry_after(FakeResponse(429, {"Retry-After": value} if value is not None else {}))
+
+    def test_delta_seconds(self):
+        self.assertEqual(self.retry_after("120"), 120.0)
+        self.assertEqual(self.retry_after("1.5"), 1.5)
+        self.assertEqual(self.retry_after("-3"), 0.0)
+
+    def test_http_date(self):
+        retry_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=30)
+        self.assertAlmostEqual(self.retry_after(format_datetime(retry_at, usegmt=True)), 30, delta=2)
+
+    def test_http_date_without_zone(self):
+        # -0000 dates are parsed as naive datetimes
+        retry_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=30)
+        self.assertAlmostEqual(self.retry_after(format_datetime(retry_at.replace(tzinfo=None))), 30, delta=2)
+
+    def test_past_http_date(self):
+        self.assertEqual(self.retry_after("Wed, 21 Oct 2015 07:28:00 GMT"), 0.0)
+
+    def test_missing_or_invalid(self):
+        self.assertIsNone(self.retry_after(None))
+        self.assertIsNone(self.retry_after(""))
+        self.assertIsNone(self.retry_after("soon"))
+
+
+class TestRetries(unittest.TestCase):
+
+    def setUp(self):
+        self.session = mock.Mock()
+        patchers = [mock.patch("client.requesting", self.session), mock.patch("client.time.sleep")]
+        for patcher in patchers:
+            self.sleep = patcher.start()
+            self.addCleanup(patcher.stop)
+        self.scheduler = create_scheduler(max_retries=2)
+        self.scheduler.bucket = mock.Mock()
+
+    def test_throttled_request_is_retried_after_retry_after(self):
+        responses = [FakeResponse(429, {"Retry-After": "7"}), FakeResponse(200)]
+        self.session.request.side_effect = responses
+        self.assertIs(self.scheduler.get("https://quickbooks/query"), responses[1])
+        self.sleep.assert_called_once_with(7.0)
+        # Other threads of the company are paused as well
+        self.scheduler.bucket.pause.assert_called_once_with(7.0)
+
+    def test_retries_are_exhausted_on_status(self):
+        self.session.request.side_effect = [FakeResponse(503) for _ in range(3)]
+        with self.assertRaises(QuickBooksClientException) as context:
+            self.scheduler.get("https://quickbooks/query")
+        self.assertIn("after 3 attempts with status 503", str(context.exception))
+        self.assertEqual(self.session.request.call_count, 3)
+
+    def test_retries_are_exhausted_on_connection_error(self):
+        self.session.request.side_effect = requests.ConnectionError("reset")
+        with self.assertRaises(QuickBooksClientException) as context:
+            self.scheduler.get("https://quickbooks/query")
+        self.assertIn("after 3 attempts", str(context.exception))
+        self.assertEqual(self.session.request.call_count, 3)
+        # Slots are released after the failed attempts
+        self.assertTrue(self.scheduler.slots.acquire(blocking=False))
+
+    def test_client_errors_are_not_retried(self):
+        response = FakeResponse(400)
+        self.session.request.return_value = response
+        self.assertIs(self.scheduler.get("https://quickbooks/query"), response)
+        self.assertEqual(self.session.request.call_count, 1)
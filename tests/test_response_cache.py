@@ -0,0 +1,217 @@
+import datetime
+import json
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from client import QuickbooksClient, TokenManager
+from response_cache import CLOSED_PERIOD_TTL, REFERENCE_TTL, ResponseCache, cache_ttl, listing_ttl
+
+BASE_URL = "https://quickbooks.api.intuit.com/v3/company/123"
+
+
+class FakeResponse:
+    """Response of the scheduler, records whether it was closed"""
+
+    def __init__(self, status_code=200, body=None, headers=None):
+        self.status_code = status_code
+        self.content = json.dumps(body).encode("utf-8") if body is not None else b""
+        self.headers = headers or {}
+        self.closed = False
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def iter_content(self, chunk_size=1):
+        yield self.content
+
+    def close(self):
+        self.closed = True
+
+
+def create_client(cache, pagination="offset"):
+    expires_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
+    tokens = TokenManager("access", "refresh", "key", "secret", expires_at=expires_at)
+    quickbooks = QuickbooksClient("123", "access", "refresh", SimpleNamespace(appKey="key", appSecret="secret"),
+                                  False, token_manager=tokens, pagination=pagination, cache=cache)
+    quickbooks.scheduler = mock.Mock()
+    return quickbooks
+
+
+class TestCacheTtl(unittest.TestCase):
+
+    def test_closed_period_report_is_cached(self):
+        self.assertEqual(cache_ttl(BASE_URL + "/reports/BalanceSheet?start_date=2020-01-01&end_date=2020-01-31"),
+                         CLOSED_PERIOD_TTL)
+
+    def test_open_period_report_is_not_cached(self):
+        end_date = datetime.date.today().isoformat()
+        self.assertIsNone(cache_ttl(BASE_URL + f"/reports/BalanceSheet?end_date={end_date}"))
+
+    def test_report_with_invalid_end_date_is_not_cached(self):
+        self.assertIsNone(cache_ttl(BASE_URL + "/reports/BalanceSheet?end_date=PrevMonthEnd"))
+        self.assertIsNone(cache_ttl(BASE_URL + "/reports/BalanceSheet"))
+
+    def test_queries_are_not_cached(self):
+        self.assertIsNone(cache_ttl(BASE_URL + "/query?query=select+count%28%2A%29+from+Class"))
+        self.assertIsNone(cache_ttl(BASE_URL + "/query?query=SELECT+%2A+FROM+Term+STARTPOSITION+1+MAXRESULTS+1000"))
+
+    def test_listing_of_reference_entities_is_cached(self):
+        self.assertEqual(listing_ttl("Class"), REFERENCE_TTL)
+        self.assertIsNone(listing_ttl("Invoice"))
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+        self.cache = ResponseCache(self.path)
+
+    def tearDown(self):
+        self.cache.close()
+        os.remove(self.path)
+
+    def test_fresh_response(self):
+        self.cache.put("key", b"body", 60, etag='"v1"')
+        cached = self.cache.get("key")
+        self.assertEqual(cached.body, b"body")
+        self.assertEqual(cached.etag, '"v1"')
+        self.assertTrue(cached.fresh)
+
+    def test_expired_response_with_validator_is_revalidated(self):
+        self.cache.put("key", b"body", 60, last_modified="Wed, 21 Oct 2020 07:28:00 GMT")
+        with mock.patch("response_cache.time.time", return_value=datetime.datetime.now().timestamp() + 120):
+            cached = self.cache.get("key")
+        self.assertEqual(cached.body, b"body")
+        self.assertFalse(cached.fresh)
+
+    def test_expired_response_without_validator_is_not_used(self):
+        self.cache.put("key", b"body", 60)
+        with mock.patch("response_cache.time.time", return_value=datetime.datetime.now().timestamp() + 120):
+            self.assertIsNone(self.cache.get("key"))
+
+    def test_touch_makes_response_fresh(self):
+        self.cache.put("key", b"body", -1, etag='"v1"')
+        self.assertFalse(self.cache.get("key").fresh)
+        self.cache.touch("key", 60)
+        self.assertTrue(self.cache.get("key").fresh)
+
+
+class TestCachedRequests(unittest.TestCase):
+    report_url = BASE_URL + "/reports/BalanceSheet?start_date=2020-01-01&end_date=2020-01-31"
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+        self.cache = ResponseCache(self.path)
+        self.quickbooks = create_client(self.cache)
+
+    def tearDown(self):
+        self.cache.close()
+        os.remove(self.path)
+
+    def expire(self):
+        self.cache._connection.execute("UPDATE responses SET expires_at = 0")
+
+    def test_report_is_revalidated_after_expiry(self):
+        report = {"Header": {"ReportName": "BalanceSheet"}}
+        self.quickbooks.scheduler.request.return_value = FakeResponse(200, report, {"ETag": '"v1"'})
+        self.assertEqual(self.quickbooks._request(self.report_url), report)
+
+        # Fresh response is served without a request
+        self.assertEqual(self.quickbooks._request(self.report_url), report)
+        self.assertEqual(self.quickbooks.scheduler.request.call_count, 1)
+
+        self.expire()
+        not_modified = FakeResponse(304)
+        self.quickbooks.scheduler.request.return_value = not_modified
+        self.assertEqual(self.quickbooks._request(self.report_url), report)
+        headers = self.quickbooks.scheduler.request.call_args[1]["headers"]
+        self.assertEqual(headers["If-None-Match"], '"v1"')
+        self.assertTrue(not_modified.closed)
+        self.assertTrue(self.cache.get(self.cache.key("123", self.report_url, {"minorversion": 75})).fresh)
+
+    def test_not_modified_stream_response_is_closed(self):
+        report = {"Header": {"ReportName": "BalanceSheet"}}
+        self.quickbooks.scheduler.request.return_value = FakeResponse(200, report, {"ETag": '"v1"'})
+        os.remove(self.quickbooks._request(self.report_url, stream=True))
+
+        self.expire()
+        not_modified = FakeResponse(304)
+        self.quickbooks.scheduler.request.return_value = not_modified
+        path = self.quickbooks._request(self.report_url, stream=True)
+        try:
+            with open(path) as f:
+                self.assertEqual(json.load(f), report)
+        finally:
+            os.remove(path)
+        self.assertTrue(not_modified.closed)
+
+    def test_modified_report_replaces_cached_response(self):
+        self.quickbooks.scheduler.request.return_value = FakeResponse(200, {"version": 1}, {"ETag": '"v1"'})
+        self.quickbooks._request(self.report_url)
+        self.expire()
+        self.quickbooks.scheduler.request.return_value = FakeResponse(200, {"version": 2}, {"ETag": '"v2"'})
+        self.assertEqual(self.quickbooks._request(self.report_url), {"version": 2})
+        self.assertEqual(self.quickbooks._request(self.report_url), {"version": 2})
+        self.assertEqual(self.quickbooks.scheduler.request.call_count, 2)
+
+
+class TestCachedListing(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+        self.cache = ResponseCache(self.path)
+        self.records = [{"Id": str(i), "Name": f"Class {i}"} for i in range(1, 4)]
+        self.queries = []
+
+    def tearDown(self):
+        self.cache.close()
+        os.remove(self.path)
+
+    def respond(self, method, url, **kwargs):
+        query = url.split("query=")[1]
+        self.queries.append(query)
+        if "count" in query:
+            return FakeResponse(200, {"QueryResponse": {"totalCount": len(self.records)}})
+        return FakeResponse(200, {"QueryResponse": {"Class": list(self.records)}})
+
+    def fetch(self, pagination="offset"):
+        quickbooks = create_client(self.cache, pagination)
+        quickbooks.scheduler.request.side_effect = self.respond
+        quickbooks.fetch("Class", False, None, None)
+        return quickbooks.data
+
+    def test_listing_is_served_from_cache(self):
+        self.assertEqual(self.fetch(), self.records)
+        self.assertEqual(len(self.queries), 2)
+
+        self.assertEqual(self.fetch(), self.records)
+        self.assertEqual(len(self.queries), 2)
+
+    def test_expired_listing_is_fetched_again_with_count(self):
+        self.fetch()
+        self.records.append({"Id": "4", "Name": "Class 4"})
+        self.cache._connection.execute("UPDATE responses SET expires_at = 0")
+
+        # Count and pages are requested together, so they come from the same snapshot
+        self.assertEqual(self.fetch(), self.records)
+        self.assertEqual(len(self.queries), 4)
+        self.assertIn("count", self.queries[2])
+
+    def test_listing_is_shared_by_paginations(self):
+        self.fetch("keyset")
+        self.assertEqual(self.fetch("offset"), self.records)
+        self.assertEqual(len(self.queries), 1)
@@ -0,0 +1,73 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+from decimal import Decimal
+
+from mapping import DATA_TYPES
+from table_writer import CsvWriter, ParquetWriter
+
+
+class TestDataTypes(unittest.TestCase):
+
+    def test_int_accepts_integral_values(self):
+        convert = DATA_TYPES["int"].convert
+        self.assertEqual(convert(3), 3)
+        self.assertEqual(convert("3"), 3)
+        self.assertEqual(convert(3.0), 3)
+
+    def test_int_rejects_fractions(self):
+        convert = DATA_TYPES["int"].convert
+        with self.assertRaises(ValueError):
+            convert(3.5)
+        with self.assertRaises(ValueError):
+            convert("3.5")
+        with self.assertRaises(ArithmeticError):
+            convert("three")
+
+
+class TestCsvWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+
+    def test_decimals_are_written_in_fixed_point_notation(self):
+        path = os.path.join(self.folder, "table.csv")
+        with CsvWriter(path, ["Amount"], mode="w", types={"Amount": "decimal"}) as writer:
+            writer.writerows([[Decimal("1E-7")], [Decimal("5E+20")], [Decimal("0E-8")], ["invalid"]])
+        with open(path) as f:
+            self.assertEqual(f.read().split(), ["0.0000001", "500000000000000000000", "0.00000000", "invalid"])
+
+
+class TestParquetWriter(unittest.TestCase):
+    types = {"Amount": "decimal", "Quantity": "int", "Active": "bool", "TxnDate": "date", "Updated": "datetime"}
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+
+    def write(self, rows):
+        path = os.path.join(self.folder, "tables", "table.parquet")
+        columns = ["Id", *self.types]
+        with ParquetWriter(path, columns, mode="w", types=self.types) as writer:
+            writer.writerows(rows)
+        import pyarrow.parquet
+        return pyarrow.parquet.read_table(path).to_pylist()
+
+    def test_matching_values_are_written(self):
+        updated = datetime.datetime(2024, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc)
+        rows = self.write([[1, Decimal("1.5"), 2, True, datetime.date(2024, 1, 2), updated]])
+        self.assertEqual(rows, [{"Id": "1", "Amount": Decimal("1.5000000000"), "Quantity": 2, "Active": True,
+                                 "TxnDate": datetime.date(2024, 1, 2), "Updated": updated}])
+
+    def test_values_not_matching_the_type_are_written_as_nulls(self):
+        with self.assertLogs(level="WARNING"):
+            rows = self.write([
+                ["1", {"value": 1}, True, 1, datetime.datetime(2024, 1, 2), datetime.date(2024, 1, 2)],
+                ["2", [1], "3.5", "yes", "2024-13-01", "invalid"],
+                ["3", Decimal("1E+40"), 2.5, 0, 20240102, 1704164645]
+            ])
+        for row in rows:
+            self.assertEqual([value for name, value in row.items() if name != "Id"], [None] * 5)
@@ -0,0 +1,72 @@
+import datetime
+import threading
+import unittest
+from unittest import mock
+
+from client import TokenManager
+
+
+class TestTokenManager(unittest.TestCase):
+
+    def setUp(self):
+        self.refreshes = 0
+        patcher = mock.patch.object(TokenManager, "refresh_request", autospec=True, side_effect=self.refresh_request)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def refresh_request(self, tokens):
+        self.refreshes += 1
+        return {"access_token": f"access{self.refreshes}", "refresh_token": f"refresh{self.refreshes}",
+                "expires_in": 3600}
+
+    @staticmethod
+    def valid_tokens(**kwargs):
+        expires_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
+        return TokenManager("access0", "refresh0", "key", "secret", expires_at=expires_at, **kwargs)
+
+    def test_token_of_unknown_expiry_is_refreshed_before_first_request(self):
+        tokens = TokenManager("access0", "refresh0", "key", "secret")
+        self.assertEqual(tokens.get_access_token(), "access1")
+        self.assertEqual(tokens.get_access_token(), "access1")
+        self.assertEqual(self.refreshes, 1)
+
+    def test_rejected_token_is_refreshed_after_proactive_refresh(self):
+        tokens = TokenManager("access0", "refresh0", "key", "secret")
+        access_token = tokens.get_access_token()
+        self.assertTrue(tokens.reject(access_token))
+        self.assertEqual(tokens.get_access_token(), "access2")
+
+    def test_token_refreshed_on_reject_is_not_refreshed_again(self):
+        tokens = self.valid_tokens()
+        self.assertTrue(tokens.reject("access0"))
+        self.assertFalse(tokens.reject("access1"))
+        self.assertEqual(self.refreshes, 1)
+
+    def test_token_refreshed_before_expiry_can_be_rejected_once(self):
+        tokens = self.valid_tokens()
+        self.assertTrue(tokens.reject("access0"))
+        # Token about to expire is refreshed proactively, its rejection gets one more refresh
+        tokens.expires_at = datetime.datetime.now(datetime.timezone.utc)
+        self.assertEqual(tokens.get_access_token(), "access2")
+        self.assertTrue(tokens.reject("access2"))
+        self.assertFalse(tokens.reject("access3"))
+
+    def test_token_refreshed_by_other_client_is_retried(self):
+        tokens = self.valid_tokens()
+        self.assertTrue(tokens.reject("access0"))
+        self.assertTrue(tokens.reject("access0"))
+        self.assertEqual(self.refreshes, 1)
+
+    def test_on_refresh_does_not_block_other_threads(self):
+        tokens_received = []
+
+        def on_refresh(tokens):
+            # Another thread gets the token while the tokens are being saved
+            thread = threading.Thread(target=lambda: tokens_received.append(tokens.get_access_token()))
+            thread.start()
+            thread.join(1)
+            self.assertFalse(thread.is_alive())
+
+        tokens = self.valid_tokens(on_refresh=on_refresh)
+        self.assertTrue(tokens.reject("access0"))
+        self.assertEqual(tokens_received, ["access1"])